@@ -1,11 +1,16 @@
 import os
+import heapq
 import itertools
 import operator
 import string
 from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
+from . import bitmap
+from . import commit_graph
 from . import data
 from . import diff
+from . import sparse
 
 
 def init():
@@ -14,117 +19,223 @@ def init():
 
 
 def write_tree():
-    """Write the current directory's state to a tree object."""
-    index_as_tree = {}
-    with data.get_index() as index:
-        for path, oid in index.items():
-            path = path.split('/')
-            dirpath, filename = path[:-1], path[-1]
-
-            current = index_as_tree
-            # Find the directory to place the file in
-            for dirname in dirpath:
-                current = current.setdefault(dirname, {})
-            current[filename] = oid
-
-    def write_tree_recursive(tree_dict):
-        entries = []
-        for name, value in tree_dict.items():
-            if type(value) is dict:
-                type_ = 'tree'
-                oid = write_tree_recursive(value)
-            else:
-                type_ = 'blob'
-                oid = value
-            entries.append((name, oid, type_))
+    """Write the index to tree objects, returning the root tree's oid.
 
-        tree_content = ''.join(f'{type_} {oid} {name}\n' for name, oid, type_ in sorted(entries))
-        return data.hash_object(tree_content.encode(), 'tree')
-    
-    return write_tree_recursive(index_as_tree)
+    Directories whose tree oid is still cached in the index are not read
+    or written again, so only the directories above changed paths are.
+    """
+    with data.get_index() as index:
+        return _write_index_tree(index, '')
+
+
+def _write_index_tree(index, dirname):
+    """Write the tree of a directory in the index, caching its oid there."""
+    oid = index.get_tree_oid(dirname)
+    if oid:
+        return oid
+    entry = index.get(f'{dirname}/')
+    if entry:
+        # Left out of a sparse checkout, the tree is already written
+        index.set_tree_oid(dirname, entry.oid)
+        return entry.oid
+
+    prefix = f'{dirname}/' if dirname else ''
+    entries = []
+    item = index.next_item(prefix)
+    while item and item[0].startswith(prefix):
+        name, sep, _ = item[0][len(prefix):].partition('/')
+        if sep:
+            entries.append((name, _write_index_tree(index, f'{prefix}{name}'), 'tree'))
+            # Skip the rest of the subdirectory, '0' sorts right after '/'
+            item = index.next_item(f'{prefix}{name}0')
+        else:
+            entries.append((name, item[1].oid, 'blob'))
+            item = index.next_item(f'{item[0]}\x00')
 
+    tree_content = ''.join(f'{type_} {oid} {name}\n' for name, oid, type_ in sorted(entries))
+    oid = data.hash_object(tree_content.encode(), 'tree')
+    index.set_tree_oid(dirname, oid)
+    return oid
 
-def _iter_tree_entries(oid):
-    """Yield entries from a tree object."""
-    if not oid:
-        return
-    tree = data.get_object(oid, 'tree')
-    for entry in tree.decode().splitlines():
-        type_, oid, name = entry.split()
-        yield type_, oid, name
 
+def get_tree(oid, base_path='', trees=None, cone=None):
+    """Retrieve the full tree structure for a given object ID.
 
-def get_tree(oid, base_path=''):
-    """Retrieve the full tree structure for a given object ID."""
+    If trees is given, the oid of every directory is recorded in it too,
+    keyed by its path without a trailing slash. Given a sparse.Cone, the
+    directories it leaves out are not read: each is returned as its path
+    with a trailing slash, mapped to its tree oid.
+    """
     result = {}
-    for type_, oid, name in _iter_tree_entries(oid):
+    if trees is not None:
+        trees[base_path.rstrip('/')] = oid
+    for type_, oid, name in data.iter_tree_entries(oid):
         assert '/' not in name
         assert name not in ('.', '..')
         path = os.path.join(base_path, name)
         if type_ == 'blob':
             result[path] = oid
+        elif type_ == 'tree' and cone and not cone.includes_dir(path):
+            result[f'{path}/'] = oid
+            if trees is not None:
+                trees[path] = oid
         elif type_ == 'tree':
-            result.update(get_tree(oid, f'{path}/'))
+            result.update(get_tree(oid, f'{path}/', trees, cone))
         else:
             raise ValueError(f'Unknown tree entry {type_}')
     return result
 
 
-def get_working_tree():
-    """Retrieve the current working tree."""
+def get_working_tree(workers=None):
+    """Retrieve the current working tree.
+
+    Files are only hashed, not stored, so the returned oids need not exist in
+    the object database until the files are added. Files are hashed on a
+    pool of worker threads. With a sparse checkout, only the files it
+    checks out are scanned; the directories it leaves out are returned as
+    they are in the index.
+    """
     result = {}
-    for root, _, filenames in os.walk('.'):
-        for filename in filenames:
-            path = os.path.relpath(os.path.join(root, filename))
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
-            with open(path, 'rb') as f:
-                result[path] = data.hash_object(f.read())
+    cone = sparse.load()
+    with data.get_index() as index:
+        paths = list(_iter_working_files('.', cone))
+        if cone:
+            # Files checked out outside the cone, like merge conflicts, are scanned too
+            paths.extend(path for path, _ in index.items()
+                         if not sparse.is_sparse_dir(path) and not cone.includes(path) and os.path.isfile(path))
+        hashed = map_parallel(lambda path: _hash_working_file(path, index.get(path)), paths, workers)
+        for path, (oid, st) in zip(paths, hashed):
+            entry = index.get(path)
+            if entry and entry.oid == oid and not data.stat_matches(entry, st):
+                # Content is unchanged, so refresh the stat data for the next scan
+                index[path] = data.make_index_entry(oid, st)
+            result[path] = oid
+        if cone:
+            result.update((path, entry.oid) for path, entry in index.items() if sparse.is_sparse_dir(path))
 
     return result
 
 
-def get_index_tree():
-    """Retrieve the current index tree"""
-    with data.get_index() as index:
-        return index
+def get_workers(workers=None):
+    """Return how many worker threads to use: workers, 'core.workers' or one per CPU."""
+    if workers is None:
+        workers = int(data.get_config('core.workers', os.cpu_count() or 1))
+    return max(workers, 1)
+
+
+def map_parallel(func, items, workers=None):
+    """Call func on each item on a pool of worker threads, returning the results in order."""
+    workers = get_workers(workers)
+    if workers == 1 or len(items) < 2:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(min(workers, len(items))) as executor:
+        return list(executor.map(func, items))
+
 
+def _iter_working_files(dirname, cone=None):
+    """Yield the normalized paths of all non-ignored files under a directory.
 
-def _empty_current_directory():
-    """Remove all files and directories from the current directory."""
-    for root, dirnames, filenames in os.walk('.', topdown=False):
+    Given a sparse.Cone, only the files it checks out are yielded.
+    """
+    for root, dirnames, filenames in os.walk(dirname):
+        # Prune ignored directories so we never descend into .agit, and those left out of the cone
+        kept = []
+        for d in dirnames:
+            path = os.path.relpath(os.path.join(root, d))
+            if not is_ignored(path) and (not cone or cone.includes_dir(path)):
+                kept.append(d)
+        dirnames[:] = kept
         for filename in filenames:
             path = os.path.relpath(os.path.join(root, filename))
-            if is_ignored(path) or not os.path.isfile(path):
+            if is_ignored(path) or not os.path.isfile(path) or (cone and not cone.includes(path)):
                 continue
-            os.remove(path)
-        for dirname in dirnames:
-            path = os.path.relpath(os.path.join(root, dirname))
-            if is_ignored(path):
-                continue
-            try:
-                os.rmdir(path)
-            except (FileNotFoundError, OSError):
-                # Deletion might fail if the directory is not empty
-                pass
+            yield path
+
 
+def _hash_working_file(path, entry):
+    """Return the oid and stat of a working file, trusting entry while its stat data is unchanged."""
+    st = os.stat(path)
+    if entry and data.stat_matches(entry, st):
+        return entry.oid, st
+    return data.hash_file(path, write=False), st
 
-def read_tree(tree_oid, update_working=False):
+
+def get_index_tree():
+    """Retrieve the current index tree, for diff.compare_trees().
+
+    Directories whose tree oid the index caches map to it with a trailing
+    slash instead of listing their files, like those a sparse checkout
+    leaves out, so comparisons skip them unread where they are unchanged.
+    If the whole tree is cached, its oid is returned.
+    """
     with data.get_index() as index:
+        root = index.get_tree_oid('')
+        if root:
+            return root
+        cached = dict(index.iter_tree_oids())
+        tree = {}
+        for path, entry in index.items():
+            dirname = ''
+            for name in path.rstrip('/').split('/')[:-1]:
+                dirname = f'{dirname}/{name}' if dirname else name
+                if dirname in cached:
+                    tree[f'{dirname}/'] = cached[dirname]
+                    break
+            else:
+                tree[path] = entry.oid
+        return tree
+
+
+def read_tree(tree_oid, update_working=False, workers=None):
+    """Read a tree into the index, checking it out too if update_working.
+
+    Checking out keeps the changes staged against HEAD, see _keep_staged().
+    """
+    with data.get_index() as index:
+        old_index = dict(index.items())
         index.clear()
-        index.update(get_tree(tree_oid))
+        trees = {}
+        for path, oid in get_tree(tree_oid, trees=trees, cone=sparse.load()).items():
+            index[path] = data.make_index_entry(oid)
+        # The index matches the tree exactly, so all of its subtrees are valid
+        for dirname, oid in trees.items():
+            index.set_tree_oid(dirname, oid)
 
         if update_working:
-            _checkout_index(index)
+            HEAD = data.get_ref('HEAD').value
+            _keep_staged(old_index, index, HEAD and get_commit(HEAD).tree)
+            _checkout_index(old_index, index, workers)
 
 
-def read_tree_merged(t_base, t_HEAD, t_other, update_working=False):
+def read_tree_merged(t_base, t_HEAD, t_other, update_working=False, workers=None):
+    """Read the merge of t_HEAD and t_other into the index, keeping the changes staged against t_HEAD."""
     with data.get_index() as index:
+        old_index = dict(index.items())
         index.clear()
-        index.update(diff.merge_trees(get_tree(t_base), get_tree(t_HEAD), get_tree(t_other)))
+        cone = sparse.load()
+        merged = get_tree(t_HEAD, cone=cone)
+        conflicts = set()
+        changes = diff.merge_trees(t_base, t_HEAD, t_other, conflicts)
+        # Left-out directories the merge changes are read in full, then left out again below
+        for path in changes:
+            dirname = path
+            while dirname:
+                dirname = dirname.rpartition('/')[0]
+                oid = merged.pop(f'{dirname}/', None)
+                if oid:
+                    merged.update(get_tree(oid, f'{dirname}/'))
+        merged.update(changes)
+        for path, oid in merged.items():
+            if oid is None:
+                continue
+            index[path] = data.make_index_entry(oid)
+        _keep_staged(old_index, index, t_HEAD)
+        if cone:
+            # Conflicts are checked out wherever they are, to be resolved
+            _leave_out_dirs(index, cone, conflicts)
 
         if update_working:
-            _checkout_index(index)
+            _checkout_index(old_index, index, workers)
 
 
 def commit(message):
@@ -138,19 +249,23 @@ def commit(message):
     MERGE_HEAD = data.get_ref('MERGE_HEAD').value
     if MERGE_HEAD:
         commit_data += f'parent {MERGE_HEAD}\n'
-        data.delete_ref('MERGE_HEAD', deref=False)
 
     commit_data += '\n' + message + '\n'
     oid = data.hash_object(commit_data.encode(), 'commit')
-    data.update_ref('HEAD', data.RefValue(symbolic=False, value=oid))
+    # Fails rather than drop a commit made meanwhile by another process
+    with data.ref_transaction() as transaction:
+        transaction.update('HEAD', data.RefValue(symbolic=False, value=oid), old=HEAD)
+        if MERGE_HEAD:
+            transaction.delete('MERGE_HEAD', old=MERGE_HEAD, deref=False)
+    write_commit_graph({oid})
     return oid
 
 
-def checkout(name):
+def checkout(name, workers=None):
     """Checkout a specific commit by its object ID."""
     oid = get_oid(name)
     commit_data = get_commit(oid)
-    read_tree(commit_data.tree, update_working=True)
+    read_tree(commit_data.tree, update_working=True, workers=workers)
 
     if is_branch(name):
         HEAD = data.RefValue(symbolic=True, value=f'refs/heads/{name}')
@@ -165,49 +280,244 @@ def reset(oid):
     data.update_ref('HEAD', data.RefValue(symbolic=False, value=oid))
 
 
-def _checkout_index(index):
-    """Read the tree object into the current directory."""
-    _empty_current_directory()
-    for path, oid in index.items():
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'wb') as f:
-            f.write(data.get_object(oid, 'blob'))
+def _keep_staged(old_index, index, HEAD_tree):
+    """Carry the changes staged in old_index against HEAD_tree over to the new index.
 
+    Raises ValueError if the new index changes a staged path as well, as
+    the staged change would be lost.
+    """
+    for path, o_HEAD, o_staged in diff.compare_trees(HEAD_tree, {p: e.oid for p, e in old_index.items()}):
+        entry = index.get(path)
+        o_new = entry and entry.oid
+        if o_new == o_staged:
+            continue
+        if o_new != o_HEAD:
+            raise ValueError(f'Staged changes to {path} would be overwritten')
+        if o_staged:
+            index[path] = old_index[path]
+        else:
+            del index[path]
+
+
+def _checkout_index(old_index, index, workers=None):
+    """Update the working directory from the old index to the new one.
+
+    Only paths whose oid changed are removed or rewritten; the rest keep
+    their files and stat data. Raises ValueError, before touching anything,
+    if that would lose local modifications. Checking, creating directories
+    and writing files are spread over a pool of worker threads.
+    """
+    # Directories left out of a sparse checkout have no files to update
+    removed = [path for path in old_index if path not in index and not sparse.is_sparse_dir(path)]
+    updated = [path for path, entry in index.items()
+               if (path not in old_index or old_index[path].oid != entry.oid) and not sparse.is_sparse_dir(path)]
+    checked = removed + updated
+    modified = map_parallel(lambda path: _is_locally_modified(path, old_index, index), checked, workers)
+    for path, is_modified in zip(checked, modified):
+        if is_modified:
+            raise ValueError(f'Local changes to {path} would be overwritten by checkout')
+
+    for path, entry in old_index.items():
+        if path in index and entry.oid == index[path].oid:
+            index[path] = entry
+
+    for path in removed:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        _remove_empty_parents(path)
+
+    dirnames = {os.path.dirname(path) for path in updated} - {''}
+    # Parents are created along with the deepest directories
+    leaves = sorted(dirnames - {os.path.dirname(dirname) for dirname in dirnames})
+    map_parallel(lambda dirname: os.makedirs(dirname, exist_ok=True), leaves, workers)
 
-def merge(other):
+    def write_file(path):
+        oid = index[path].oid
+        with open(path, 'wb') as f:
+            for chunk in data.iter_object(oid, 'blob'):
+                f.write(chunk)
+        return data.make_index_entry(oid, os.stat(path))
+
+    # Partial clones get the blobs they lack in one round, not one per file
+    data.prefetch_objects(index[path].oid for path in updated)
+    for path, entry in zip(updated, map_parallel(write_file, updated, workers)):
+        index[path] = entry
+
+
+def _is_locally_modified(path, old_index, index):
+    """Tell whether checkout would lose the working copy of a path.
+
+    That is when the file matches neither its old nor its new index entry,
+    or when it is in the way of a new file without being tracked.
+    """
+    try:
+        st = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+
+    if os.path.isdir(path):
+        # Only tracked files, which are removed first, may be in the way
+        return any(p not in old_index for p in _iter_working_files(path))
+
+    old_entry = old_index.get(path)
+    if old_entry and data.stat_matches(old_entry, st):
+        return False
+    oid = data.hash_file(path, write=False)
+    return not any(entry and entry.oid == oid for entry in (old_entry, index.get(path)))
+
+
+def sparse_checkout(dirnames, workers=None):
+    """Check out only the given directories, or the whole tree if dirnames is None.
+
+    The index and working directory are updated to the new cone, see
+    sparse. Raises ValueError, before changing anything, if files to be
+    removed have local modifications.
+    """
+    cone = None if dirnames is None else sparse.Cone(dirnames)
+    with data.get_index() as index:
+        old_index = dict(index.items())
+        for path, entry in old_index.items():
+            if sparse.is_sparse_dir(path) and (not cone or cone.includes_dir(path[:-1])):
+                del index[path]
+                trees = {}
+                for subpath, oid in get_tree(entry.oid, path, trees, cone).items():
+                    index[subpath] = data.make_index_entry(oid)
+                for dirname, oid in trees.items():
+                    index.set_tree_oid(dirname, oid)
+        if cone:
+            _leave_out_dirs(index, cone)
+
+        _checkout_index(old_index, index, workers)
+        sparse.write(dirnames)
+
+
+def _leave_out_dirs(index, cone, kept=()):
+    """Replace the entries below each directory a sparse.Cone leaves out with one for the directory.
+
+    The paths in kept stay as they are, and so do the directories above them.
+    """
+    kept_dirs = set()
+    for path in kept:
+        while path:
+            path = path.rpartition('/')[0]
+            kept_dirs.add(path)
+
+    left_out = {}
+    for path in index:
+        # The top-most directory left out, checking a directory entry itself too
+        dirnames = []
+        dirname = path
+        while dirname:
+            dirname = dirname.rpartition('/')[0]
+            dirnames.append(dirname)
+        top = next((dirname for dirname in reversed(dirnames)
+                    if dirname and not cone.includes_dir(dirname) and dirname not in kept_dirs), None)
+        if top and path != f'{top}/':
+            left_out.setdefault(top, []).append(path)
+
+    for dirname, paths in left_out.items():
+        oid = _write_index_tree(index, dirname)
+        for path in paths:
+            del index[path]
+        index[f'{dirname}/'] = data.make_index_entry(oid)
+        index.set_tree_oid(dirname, oid)
+
+
+def _remove_empty_parents(path):
+    """Remove the directories above a path for as long as they are empty."""
+    dirname = os.path.dirname(path)
+    while dirname:
+        try:
+            os.rmdir(dirname)
+        except OSError:
+            break
+        dirname = os.path.dirname(dirname)
+
+
+def merge(other, workers=None):
     """Merge the specified branch into the current one."""
     HEAD = data.get_ref('HEAD').value
     assert HEAD
+    # Refuse before touching the index or working directory, which hold the unfinished merge
+    MERGE_HEAD = data.get_ref('MERGE_HEAD').value
+    if MERGE_HEAD:
+        raise ValueError(f'Merge with {MERGE_HEAD[:10]} is not concluded, use "agit commit" first')
     merge_base = get_merge_base(other, HEAD)
     c_other = get_commit(other)
 
     # Handle Fast-forward Merge: the current branch is an ancestor of the other branch
     if merge_base == HEAD:
-        read_tree(c_other.tree, update_working=True)
-        data.update_ref('HEAD', data.RefValue(symbolic=False, value=other))
+        read_tree(c_other.tree, update_working=True, workers=workers)
+        with data.ref_transaction() as transaction:
+            transaction.update('HEAD', data.RefValue(symbolic=False, value=other), old=HEAD)
         print(f'Fast-forward merge, no need to commit. Use "agit checkout {other}" to access the new changes.')
         return
 
-    data.update_ref('MERGE_HEAD', data.RefValue(symbolic=False, value=other))
-
     c_base = get_commit(merge_base)
     c_HEAD = get_commit(HEAD)
-    read_tree_merged(c_base.tree, c_HEAD.tree, c_other.tree, update_working=True)
+    read_tree_merged(c_base.tree, c_HEAD.tree, c_other.tree, update_working=True, workers=workers)
+    with data.ref_transaction() as transaction:
+        transaction.update('MERGE_HEAD', data.RefValue(symbolic=False, value=other), old=None, deref=False)
     print('Merged in working directory. Use "agit commit" to conclude merge.')
 
 
 def get_merge_base(oid1, oid2):
-    """Retrieve the merge base of two commits."""
-    parents1 = set(iter_commits_and_parents({oid1}))
+    """Retrieve the merge base of two commits.
+
+    With both commits in the commit-graph, the two histories are walked
+    together in decreasing generation order. A commit is only visited after
+    all of its descendants, so the first one reached from both sides is a
+    merge base and the walk stops there.
+    """
+    graph = commit_graph.load()
+    if oid1 not in graph or oid2 not in graph:
+        parents1 = set(iter_commits_and_parents({oid1}))
+        for oid in iter_commits_and_parents({oid2}):
+            if oid in parents1:
+                return oid
+        return None
 
-    for oid in iter_commits_and_parents({oid2}):
-        if oid in parents1:
+    flags = {oid1: 1}
+    flags[oid2] = flags.get(oid2, 0) | 2
+    queue = [(-graph.get_generation(oid), oid) for oid in flags]
+    heapq.heapify(queue)
+    while queue:
+        _, oid = heapq.heappop(queue)
+        if flags[oid] == 3:
             return oid
+        for parent in graph.get_parents(oid):
+            parent_flags = flags.get(parent, 0)
+            if parent_flags | flags[oid] != parent_flags:
+                flags[parent] = parent_flags | flags[oid]
+                heapq.heappush(queue, (-graph.get_generation(parent), parent))
+    return None
         
 
 def is_ancestor(commit, maybe_descendant):
-    """Determine if a commit is an ancestor of another commit."""
-    return maybe_descendant in iter_commits_and_parents({commit})
+    """Determine if a commit is an ancestor of another commit.
+
+    Note that despite the names, this checks whether maybe_descendant is
+    reachable from commit. With the commit-graph, the walk skips any commit
+    whose generation is too low to reach maybe_descendant.
+    """
+    graph = commit_graph.load()
+    if commit not in graph or maybe_descendant not in graph:
+        return maybe_descendant in iter_commits_and_parents({commit})
+
+    min_generation = graph.get_generation(maybe_descendant)
+    oids = [commit]
+    visited = set()
+    while oids:
+        oid = oids.pop()
+        if oid == maybe_descendant:
+            return True
+        if oid in visited or graph.get_generation(oid) <= min_generation:
+            continue
+        visited.add(oid)
+        oids.extend(graph.get_parents(oid))
+    return False
 
 
 def create_tag(name, oid):
@@ -224,9 +534,20 @@ Commit = namedtuple('Commit', ['tree', 'parents', 'message'])
 
 
 def get_commit(oid):
-    """Retrieve a commit object by its ID."""
+    """Retrieve a commit object by its ID.
+
+    The boundary commits of a shallow repository come without parents.
+    """
+    commit = data.get_parsed_object(oid, 'commit', _parse_commit)
+    if commit.parents and oid in data.get_shallow():
+        commit = commit._replace(parents=[])
+    return commit
+
+
+def _parse_commit(commit):
+    """Parse the content of a commit object."""
     parents = []
-    commit = data.get_object(oid, 'commit').decode()
+    commit = commit.decode()
     lines = iter(commit.splitlines())
     for line in itertools.takewhile(operator.truth, lines):
         key, value = line.split(' ', 1)
@@ -241,10 +562,15 @@ def get_commit(oid):
     return Commit(tree=tree, parents=parents, message=message)
 
 
-def iter_commits_and_parents(oids):
-    """Iterate through a set of commits and their parents."""
+def iter_commits_and_parents(oids, shallow=frozenset()):
+    """Iterate through a set of commits and their parents.
+
+    The commits in shallow are taken as having no parents, as in another
+    repository whose boundary commits they are.
+    """
     oids = deque(set(oids))
     visited = set()
+    graph = commit_graph.load()
 
     while oids:
         oid = oids.popleft()
@@ -253,11 +579,39 @@ def iter_commits_and_parents(oids):
         visited.add(oid)
         yield oid
 
-        commit = get_commit(oid)
+        parents = [] if oid in shallow else graph.get_parents(oid)
+        if parents is None:
+            parents = get_commit(oid).parents
         # Return first parent first, so it is processed first
-        oids.extendleft(commit.parents[:1])
+        oids.extendleft(parents[:1])
         # Return other parents in reverse order, so they are processed last
-        oids.extend(commit.parents[1:])
+        oids.extend(parents[1:])
+
+
+def set_shallow(oids):
+    """Replace the boundary commits of a shallow repository, see data.get_shallow()."""
+    if set(oids) != data.get_shallow():
+        data.write_shallow(oids)
+        # The graph recorded parents for commits that are now boundaries, or none
+        # for boundaries that are not anymore
+        commit_graph.clear()
+
+
+def write_commit_graph(oids):
+    """Add the given commits and all their ancestors to the commit-graph."""
+    graph = commit_graph.load()
+    commits = {}
+    oids = list(oids)
+    while oids:
+        oid = oids.pop()
+        if not oid or oid in commits or oid in graph:
+            continue
+        commit = get_commit(oid)
+        commits[oid] = commit.tree, commit.parents
+        oids.extend(commit.parents)
+
+    if commits:
+        commit_graph.write(commits)
 
 
 def get_oid(name):
@@ -273,8 +627,9 @@ def get_oid(name):
     ]
 
     for ref in refs_to_try:
-        if data.get_ref(ref, deref=False).value:
-            return data.get_ref(ref).value
+        value = data.get_ref(ref, deref=False)
+        if value.value:
+            return data.get_ref(ref).value if value.symbolic else value.value
 
     is_hex = all(c in string.hexdigits for c in name)
     if len(name) == 40 and is_hex:
@@ -314,7 +669,7 @@ def iter_objects_in_commits(oids):
     def iter_objects_in_tree(oid):
         visited.add(oid)
         yield oid
-        for type_, oid, _ in _iter_tree_entries(oid):
+        for type_, oid, _ in data.iter_tree_entries(oid):
             if oid not in visited:
                 if type_ == 'tree':
                     yield from iter_objects_in_tree(oid)
@@ -329,30 +684,354 @@ def iter_objects_in_commits(oids):
             yield from iter_objects_in_tree(commit.tree)
     
 
-def add(filenames):
-    """Add files to the index."""
+def iter_new_commits(wants, haves):
+    """Yield the commits reachable from wants but not from haves.
+
+    Both sides are walked together in decreasing generation order, marking
+    the commits they reach, so a commit is only judged after all of its
+    descendants. The walk stops once only common commits are left, which
+    is the frontier between the two histories. Nothing is written, as the
+    walk may run in a remote repository: commits missing from the
+    commit-graph are read instead, their generations computed in memory.
+    """
+    NEW, COMMON = 1, 2
+    graph = commit_graph.load()
+    generations = {}
+
+    def get_parents(oid):
+        parents = graph.get_parents(oid)
+        return parents if parents is not None else get_commit(oid).parents
+
+    def get_generation(oid):
+        stack = [oid]
+        while stack:
+            current = stack[-1]
+            if current in generations:
+                stack.pop()
+                continue
+            if current in graph:
+                generations[current] = graph.get_generation(current)
+                stack.pop()
+                continue
+            parents = get_commit(current).parents
+            pending = [parent for parent in parents if parent not in generations]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            generations[current] = 1 + max((generations[parent] for parent in parents), default=0)
+        return generations[oid]
+
+    flags = {}
+    for oids, flag in ((wants, NEW), (haves, COMMON)):
+        for oid in oids:
+            flags[oid] = flags.get(oid, 0) | flag
+    queue = [(-get_generation(oid), oid) for oid in flags]
+    heapq.heapify(queue)
+    done = set()
+    while queue and any(not flags[oid] & COMMON for _, oid in queue):
+        _, oid = heapq.heappop(queue)
+        if oid in done:
+            continue
+        done.add(oid)
+        if flags[oid] == NEW:
+            yield oid
+        for parent in get_parents(oid):
+            parent_flags = flags.get(parent, 0)
+            if parent_flags | flags[oid] != parent_flags:
+                flags[parent] = parent_flags | flags[oid]
+                heapq.heappush(queue, (-get_generation(parent), parent))
+
+
+def iter_missing_objects(wants, haves, blobs=True):
+    """Yield the objects reachable from wants that haves lack, without blobs if not blobs.
+
+    haves must be commits whose objects are all present on the other side.
+    Each new commit's tree is compared with its parents' trees, descending
+    only into entries that differ from the parents' at the same path, so
+    shared subtrees are never read. The result may include a few objects
+    the other side also has, but never misses one.
+
+    If a pack has reachability bitmaps, the objects are instead the
+    difference of the bitmaps reachable from each side. Shallow
+    repositories don't use them, as their history may have grown deeper
+    since the bitmaps were written. Bitmaps don't tell blobs apart either.
+    """
+    bitmaps = None if data.get_shallow() or not blobs else data.get_bitmaps()
+    if bitmaps:
+        want_bits, want_extra = _get_reachable(bitmaps.pack, bitmaps.get, wants)
+        have_bits, have_extra = _get_reachable(bitmaps.pack, bitmaps.get, haves)
+        yield from bitmaps.iter_oids(want_bits & ~have_bits)
+        yield from want_extra - have_extra
+        return
+
+    yield from _iter_changed_objects(iter_new_commits(wants, haves), lambda commit: commit.parents, blobs)
 
-    def add_file(filename):
-        # Normalize the path
-        filename = os.path.relpath(filename)
-        with open(filename, 'rb') as f:
-            oid = data.hash_object(f.read())
-        index[filename] = oid
 
-    def add_directory(dirname):
-        for root, _, filenames in os.walk(dirname):
-            for filename in filenames:
-                # Normalize the path
-                path = os.path.relpath(os.path.join(root, filename))
-                if is_ignored(path) or not os.path.isfile(path):
-                    continue
-                add_file(path)
+def check_connected(oid, haves):
+    """Raise ValueError unless every object reachable from commit oid is here.
+
+    History reachable from haves is known to be complete, so only the
+    commits on top of it are walked, with the objects of their trees that
+    their parents' trees lack.
+    """
+    try:
+        for obj in _iter_changed_objects(iter_new_commits([oid], haves), lambda commit: commit.parents):
+            if not data.object_exists(obj):
+                raise ValueError(f'Object {obj} not found')
+    except FileNotFoundError:
+        # A parent commit was read before it could be checked
+        raise ValueError(f'{oid[:10]} is missing objects')
 
+
+def _iter_changed_objects(commits, get_parents, blobs=True):
+    """Yield commits and the objects of their trees that their parents' trees lack.
+
+    get_parents returns the parents of a commit whose trees are present on
+    the other side, or sent along. Each tree is compared with those parents'
+    trees, descending only into entries that differ from the parents' at
+    the same path, so shared subtrees are never read. Blobs are left out
+    if not blobs.
+    """
+    visited = set()
+
+    def iter_tree_changes(oid, parent_trees):
+        if oid in visited or oid in parent_trees:
+            return
+        visited.add(oid)
+        yield oid
+        parent_entries = [
+            {name: entry_oid for _, entry_oid, name in data.iter_tree_entries(tree)}
+            for tree in parent_trees if tree]
+        for type_, entry_oid, name in data.iter_tree_entries(oid):
+            parent_oids = [entries.get(name) for entries in parent_entries]
+            if entry_oid in visited or entry_oid in parent_oids:
+                continue
+            if type_ == 'tree':
+                yield from iter_tree_changes(entry_oid, parent_oids)
+            elif blobs:
+                visited.add(entry_oid)
+                yield entry_oid
+
+    for oid in commits:
+        yield oid
+        commit = get_commit(oid)
+        parent_trees = [get_commit(parent).tree for parent in get_parents(commit)]
+        yield from iter_tree_changes(commit.tree, parent_trees)
+
+
+def get_fetch_objects(wants, haves, shallow=(), depth=None, exclude=(), blobs=True):
+    """Find the objects another repository fetching wants lacks.
+
+    haves are its ref values, which need not exist here, shallow its
+    boundary commits and exclude names of refs here. Without blobs, only
+    commits and trees are sent, for a partial clone. Returns the objects
+    and its new boundary commits, see get_shallow_objects().
+    """
+    haves = [oid for oid in haves if data.object_exists(oid)]
+    exclude = [get_oid(name) for name in exclude]
+    if shallow or depth is not None or exclude:
+        return get_shallow_objects(wants, haves, shallow, depth, exclude, blobs)
+    return list(iter_missing_objects(wants, haves, blobs)), set()
+
+
+def get_shallow_objects(wants, haves, shallow=(), depth=None, exclude=(), blobs=True):
+    """Find the objects to send to a shallow repository, or to make one.
+
+    shallow are the other side's boundary commits. The history of wants is
+    cut depth commits deep, the tips being 1 deep, and above the commits
+    reachable from exclude. Boundary commits of the other side within that
+    depth are deepened, the others are left as they are. Nothing is sent
+    for wants that are excluded themselves.
+
+    Returns the objects to send and the other side's new boundary commits.
+    """
+    shallow = frozenset(shallow)
+    have_commits = set(iter_commits_and_parents(haves, shallow))
+    excluded = set(iter_commits_and_parents(exclude))
+
+    commits = []
+    boundary = set()
+    deepened = set()
+    visited = set()
+    queue = deque((oid, 1) for oid in wants)
+    while queue:
+        oid, commit_depth = queue.popleft()
+        if oid in visited:
+            continue
+        visited.add(oid)
+        if oid in excluded:
+            # Only tips can be, their parents are never walked past the cut
+            continue
+
+        if oid in have_commits:
+            # Walk on to the other side's boundary commits within the depth
+            if depth is None or commit_depth >= depth:
+                continue
+            if oid in shallow:
+                deepened.add(oid)
+        else:
+            commits.append(oid)
+
+        parents = get_commit(oid).parents
+        cut = depth is not None and commit_depth >= depth or any(parent in excluded for parent in parents)
+        if cut and any(parent not in have_commits for parent in parents):
+            boundary.add(oid)
+        elif not cut:
+            queue.extend((parent, commit_depth + 1) for parent in parents)
+
+    # Trees are only diffed against parents the other side ends up with
+    sent = set(commits)
+    objects = list(_iter_changed_objects(commits, lambda commit: [
+        parent for parent in commit.parents if parent in have_commits or parent in sent], blobs))
+    return objects, (shallow - deepened) | boundary
+
+
+def _get_reachable(pack_, get_bitmap, tips):
+    """Find the objects reachable from some commits, as a bitmap over a pack.
+
+    Returns the bitmap of the reachable objects in the pack and the set of
+    those outside of it. Commits for which get_bitmap returns a bitmap are
+    not walked, their bitmap is taken as it is.
+    """
+    marks = bytearray((len(pack_.index) + 7) // 8)
+    extra = set()
+
+    def mark(oid):
+        """Mark an object as reachable, returning False if it already was."""
+        pos = pack_.index.find_position(oid)
+        if pos is None:
+            if oid in extra:
+                return False
+            extra.add(oid)
+            return True
+        if marks[pos >> 3] >> (pos & 7) & 1:
+            return False
+        marks[pos >> 3] |= 1 << (pos & 7)
+        return True
+
+    commits = list(tips)
+    while commits:
+        oid = commits.pop()
+        bits = get_bitmap(oid)
+        if bits is not None:
+            marks[:] = (int.from_bytes(marks, 'little') | bits).to_bytes(len(marks), 'little')
+            continue
+        if not mark(oid):
+            continue
+
+        commit = get_commit(oid)
+        commits.extend(commit.parents)
+        trees = [commit.tree]
+        while trees:
+            tree = trees.pop()
+            if not mark(tree):
+                continue
+            for type_, entry_oid, _ in data.iter_tree_entries(tree):
+                if type_ == 'tree':
+                    trees.append(entry_oid)
+                else:
+                    mark(entry_oid)
+
+    return int.from_bytes(marks, 'little'), extra
+
+
+def write_bitmaps(path, commits):
+    """Write reachability bitmaps for some commits of the pack at path.
+
+    Commits are done in increasing generation order, so each one reuses the
+    bitmaps of its ancestors that have one instead of walking their history.
+    """
+    pack_ = data.get_pack(path)
+    graph = commit_graph.load()
+    bitmaps = {}
+    for oid in sorted(commits, key=graph.get_generation):
+        bitmaps[oid] = _get_reachable(pack_, bitmaps.get, [oid])[0]
+    bitmap.write(pack_, bitmaps)
+
+
+def repack(prune_expire=None):
+    """Pack everything reachable from the refs and the index into one pack.
+
+    Partial clones leave out the blobs they don't have, which their
+    promisor remote keeps for them.
+
+    Given prune_expire in seconds, unreachable loose objects older than
+    that are deleted as well. Unless 'pack.writeBitmaps' is off or the
+    repository is shallow, the pack gets reachability bitmaps for the ref
+    tips and every 'pack.bitmapInterval'th commit.
+    """
+    objects = {}
+    partial = bool(data.get_config('remote.promisor'))
+
+    def add_tree(oid, path):
+        objects[oid] = 'tree', path
+        for type_, oid, name in data.iter_tree_entries(oid):
+            if oid in objects:
+                continue
+            if type_ == 'tree':
+                add_tree(oid, f'{path}{name}/')
+            elif not partial or data.object_exists(oid):
+                objects[oid] = type_, f'{path}{name}'
+
+    ref_oids = {ref.value for _, ref in data.iter_refs()}
+    write_commit_graph(ref_oids)
+    bitmap_interval = int(data.get_config('pack.bitmapInterval', 100))
+    bitmap_commits = set(ref_oids)
+    for i, oid in enumerate(iter_commits_and_parents(ref_oids)):
+        objects[oid] = 'commit', ''
+        if i % bitmap_interval == 0:
+            bitmap_commits.add(oid)
+        tree = get_commit(oid).tree
+        if tree not in objects:
+            add_tree(tree, '')
+
+    # Staged but uncommitted blobs must survive too
+    with data.get_index() as index:
+        for path, entry in index.items():
+            if entry.oid in objects or not data.object_exists(entry.oid):
+                continue
+            if sparse.is_sparse_dir(path):
+                add_tree(entry.oid, path)
+            else:
+                objects[entry.oid] = 'blob', path
+        # As are the trees cached in the index, which the next commit reuses
+        for dirname, oid in index.iter_tree_oids():
+            if oid not in objects and data.object_exists(oid):
+                add_tree(oid, f'{dirname}/' if dirname else '')
+
+    objects = [(oid, type_, path) for oid, (type_, path) in objects.items()]
+    path = data.repack(objects, prune_expire)
+    if data.get_config('pack.writeBitmaps', 'true') == 'true' and not data.get_shallow():
+        write_bitmaps(path, bitmap_commits)
+    return path
+
+
+def add(filenames, workers=None):
+    """Add files to the index, hashing them on a pool of worker threads."""
+
+    def add_file(path):
+        st = os.stat(path)
+        entry = index.get(path)
+        if entry and data.stat_matches(entry, st):
+            # Already staged and untouched since, no need to rehash
+            return entry
+        return data.make_index_entry(data.hash_file(path), st)
+
+    cone = sparse.load()
     with data.get_index() as index:
+        paths = []
         for name in filenames:
             if os.path.isfile(name):
-                add_file(name)
+                # Normalize the path
+                path = os.path.relpath(name)
+                if cone and not cone.includes(path) and path not in index:
+                    raise ValueError(f'{path} is outside the sparse-checkout cone')
+                paths.append(path)
             elif os.path.isdir(name):
-                add_directory(name)
+                paths.extend(_iter_working_files(name, cone))
+
+        for path, entry in zip(paths, map_parallel(add_file, paths, workers)):
+            index[path] = entry
 
 
@@ -0,0 +1,103 @@
+"""Reachability bitmaps: the objects reachable from selected commits of a pack.
+
+A pack's .bitmap companion holds, for some of the commits in the pack, a
+bitmap with bit i set if the object at position i of the pack index is
+reachable from the commit. Bitmaps are stored as zlib-deflated
+little-endian integers, sorted by commit oid. With them, the objects
+reachable from one set of commits and not from another is a single
+AND-NOT of integers.
+"""
+
+import hashlib
+import os
+import struct
+import tempfile
+import zlib
+
+from . import data
+from . import pack
+
+
+SIGNATURE = b'ABMP'
+VERSION = 1
+
+_HEADER = struct.Struct('>4sI20sI')
+_RECORD = struct.Struct('>20sI')
+
+_bitmap_cache = {}
+
+
+class PackBitmaps:
+    """The reachability bitmaps of one pack, keyed by commit oid."""
+
+    def __init__(self, pack_, bitmaps):
+        self.pack = pack_
+        self._bitmaps = bitmaps
+
+    def __contains__(self, oid):
+        return oid in self._bitmaps
+
+    def get(self, oid):
+        """Return the bitmap of a commit as an int, or None if it has none."""
+        compressed = self._bitmaps.get(oid)
+        if compressed is None:
+            return None
+        return int.from_bytes(zlib.decompress(compressed), 'little')
+
+    def iter_oids(self, bits):
+        """Yield the oids of the objects set in a bitmap."""
+        for i, byte in enumerate(bits.to_bytes((bits.bit_length() + 7) // 8, 'little')):
+            if byte:
+                for bit in range(8):
+                    if byte >> bit & 1:
+                        yield self.pack.index.oid_at(8 * i + bit)
+
+
+def load(pack_):
+    """Load the bitmaps of a pack, or return None if it has none."""
+    path = f'{pack_.path}.bitmap'
+    if path in _bitmap_cache:
+        return _bitmap_cache[path]
+
+    bitmaps = None
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+    except FileNotFoundError:
+        content = None
+
+    if content:
+        signature, version, pack_checksum, count = _HEADER.unpack_from(content)
+        if signature != SIGNATURE or version != VERSION or pack_checksum.hex() != pack_.path[-40:]:
+            raise ValueError(f'Unsupported bitmap {path}')
+        if hashlib.sha1(content[:-20]).digest() != content[-20:]:
+            raise ValueError(f'Corrupt bitmap {path}')
+        entries = {}
+        at = _HEADER.size
+        for _ in range(count):
+            oid, size = _RECORD.unpack_from(content, at)
+            at += _RECORD.size
+            entries[oid.hex()] = content[at:at + size]
+            at += size
+        bitmaps = PackBitmaps(pack_, entries)
+
+    _bitmap_cache[path] = bitmaps
+    return bitmaps
+
+
+def write(pack_, bitmaps):
+    """Write the bitmaps of a pack, given as {commit oid: int}."""
+    records = []
+    for oid in sorted(bitmaps):
+        bits = bitmaps[oid]
+        compressed = zlib.compress(bits.to_bytes((bits.bit_length() + 7) // 8, 'little'))
+        records.append(_RECORD.pack(bytes.fromhex(oid), len(compressed)) + compressed)
+    content = _HEADER.pack(SIGNATURE, VERSION, bytes.fromhex(pack_.path[-40:]), len(records)) + b''.join(records)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(pack_.path), prefix='tmp_bitmap_')
+    data.make_read_only(fd)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(content)
+        f.write(hashlib.sha1(content).digest())
+    os.replace(tmp_path, f'{pack_.path}.bitmap')
+    _bitmap_cache.pop(f'{pack_.path}.bitmap', None)
@@ -7,7 +7,10 @@ import subprocess
 from . import base
 from . import data
 from . import diff
+from . import protocol
 from . import remote
+from . import server
+from . import sparse
 
 
 def main():
@@ -38,6 +41,7 @@ def parse_args():
     # Command to store a given blob in the repository
     hash_object_parser = commands.add_parser('hash-object', help='Store a given blob in the repository')
     hash_object_parser.add_argument('file')
+    hash_object_parser.add_argument('--no-write', action='store_true', help='Only compute the object ID, do not store the blob')
     hash_object_parser.set_defaults(func=hash_object)
 
     # Command to display content of repository objects
@@ -74,10 +78,12 @@ def parse_args():
     diff_parser.set_defaults(func=_diff)
     diff_parser.add_argument('--cached', action='store_true')
     diff_parser.add_argument('commit', nargs='?')
+    diff_parser.add_argument('-j', '--jobs', type=int, metavar='N', help='Number of worker threads (default: core.workers, one per CPU)')
 
     # Command to checkout a commit by its object ID
     checkout_parser = commands.add_parser('checkout', help='Checkout a commit inside the current directory')
     checkout_parser.add_argument('commit')
+    checkout_parser.add_argument('-j', '--jobs', type=int, metavar='N', help='Number of worker threads (default: core.workers, one per CPU)')
     checkout_parser.set_defaults(func=checkout)
 
     # Command to create a tag reference
@@ -99,6 +105,7 @@ def parse_args():
     # Command to show the working tree status
     status_parser = commands.add_parser('status', help='Show the working tree status')
     status_parser.set_defaults(func=status)
+    status_parser.add_argument('-j', '--jobs', type=int, metavar='N', help='Number of worker threads (default: core.workers, one per CPU)')
 
     # Command to reset the current HEAD to the specified object ID  (Commit)
     reset_parser = commands.add_parser('reset', help='Reset the current HEAD to the specified object ID (Commit)')
@@ -108,6 +115,7 @@ def parse_args():
     # Command to merge the specified commit into the current branch
     merge_parser = commands.add_parser('merge', help='Merge the specified commit into the current branch')
     merge_parser.add_argument('commit', type=oid)
+    merge_parser.add_argument('-j', '--jobs', type=int, metavar='N', help='Number of worker threads (default: core.workers, one per CPU)')
     merge_parser.set_defaults(func=merge)
 
     # Command to show the merge base of two commits
@@ -118,20 +126,63 @@ def parse_args():
 
     # Command to fetch changes from a remote repository
     fetch_parser = commands.add_parser('fetch', help='Fetch changes from a remote repository')
-    fetch_parser.add_argument('remote')
+    fetch_parser.add_argument('remote', help='Path of the remote repository, or an agit://host[:port] or unix:path URL')
+    fetch_parser.add_argument('--depth', type=int, metavar='N', help='Only fetch the last N commits of each branch')
+    fetch_parser.add_argument('--shallow-exclude', action='append', default=[], metavar='REF',
+                              help='Only fetch commits not reachable from a remote ref, may be repeated')
+    fetch_parser.add_argument('--filter', choices=['blob:none'], dest='filter_spec',
+                              help='Leave blobs on the remote and fetch them when first needed')
     fetch_parser.set_defaults(func=fetch)
 
     # Command to push changes to a remote repository
     push_parser = commands.add_parser('push', help='Push changes to a remote repository')
-    push_parser.add_argument('remote')
+    push_parser.add_argument('remote', help='Path of the remote repository, or an agit://host[:port] or unix:path URL')
     push_parser.add_argument('branch')
     push_parser.set_defaults(func=push)
 
     # Command to add file contents to the index
     add_parser = commands.add_parser('add', help='Add file contents to the index')
     add_parser.add_argument('files', nargs='+')
+    add_parser.add_argument('-j', '--jobs', type=int, metavar='N', help='Number of worker threads (default: core.workers, one per CPU)')
     add_parser.set_defaults(func=add)
 
+    # Command to get or set repository options
+    config_parser = commands.add_parser('config', help='Get or set repository options')
+    config_parser.add_argument('key')
+    config_parser.add_argument('value', nargs='?')
+    config_parser.set_defaults(func=config)
+
+    # Command to move loose objects into the fan-out directory layout
+    migrate_objects_parser = commands.add_parser('migrate-objects', help='Move loose objects into the fan-out directory layout')
+    migrate_objects_parser.set_defaults(func=migrate_objects)
+
+    # Command to move loose refs into the packed-refs file
+    pack_refs_parser = commands.add_parser('pack-refs', help='Move loose refs into the packed-refs file')
+    pack_refs_parser.set_defaults(func=pack_refs)
+
+    # Command to pack all reachable objects into a single pack
+    repack_parser = commands.add_parser('repack', help='Pack all reachable objects into a single delta-compressed pack')
+    repack_parser.set_defaults(func=repack)
+
+    # Command to repack and prune unreachable objects
+    gc_parser = commands.add_parser('gc', help='Repack reachable objects and prune unreachable ones')
+    gc_parser.add_argument('--prune', type=int, metavar='SECONDS',
+                           help='Grace period for unreachable objects (default: gc.pruneExpire, two weeks)')
+    gc_parser.set_defaults(func=gc)
+
+    # Command to serve the repository to remote clients
+    serve_parser = commands.add_parser('serve', help='Serve the repository to fetch and push over a socket')
+    serve_parser.add_argument('url', nargs='?', default=f'agit://localhost:{protocol.DEFAULT_PORT}',
+                              help='agit://host[:port] or unix:path to listen on (default: %(default)s)')
+    serve_parser.set_defaults(func=serve)
+
+    # Command to check out only some directories
+    sparse_checkout_parser = commands.add_parser('sparse-checkout', help='Check out only some directories of the tree')
+    sparse_checkout_parser.add_argument('dirs', nargs='*', help='Directories to check out (default: list the current ones)')
+    sparse_checkout_parser.add_argument('--disable', action='store_true', help='Check out the whole tree again')
+    sparse_checkout_parser.add_argument('-j', '--jobs', type=int, metavar='N', help='Number of worker threads (default: core.workers, one per CPU)')
+    sparse_checkout_parser.set_defaults(func=sparse_checkout)
+
 
     return parser.parse_args()
 
@@ -144,14 +195,14 @@ def init(args):
 
 def hash_object(args):
     """Hash a file and print its object ID."""
-    with open(args.file, 'rb') as f:
-        print(data.hash_object(f.read()))
+    print(data.hash_file(args.file, write=not args.no_write))
 
 
 def cat_file(args):
     """Print the content of the specified object."""
     sys.stdout.flush()
-    sys.stdout.buffer.write(data.get_object(args.object, expected=None))
+    for chunk in data.iter_object(args.object, expected=None):
+        sys.stdout.buffer.write(chunk)
 
 
 def write_tree(args):
@@ -198,7 +249,7 @@ def show(args):
         parent_tree = base.get_commit(commit.parents[0]).tree
 
     _print_commit(args.oid, commit)
-    result = diff.diff_trees(base.get_tree(parent_tree), base.get_tree(commit.tree))
+    result = diff.diff_trees(parent_tree, commit.tree)
     sys.stdout.flush()
     sys.stdout.buffer.write(result)
 
@@ -208,28 +259,28 @@ def _diff(args):
 
     if args.commit:
         # If a commit is specified, show the diff between the commit and the working tree
-        tree_from = base.get_tree(oid and base.get_commit(oid).tree)
+        tree_from = oid and base.get_commit(oid).tree
     
     if args.cached:
         tree_to = base.get_index_tree()
         if not args.commit:
             # If no commit is specified, show the diff between the index and the working tree
             oid = base.get_oid('@')
-            tree_from = base.get_tree(oid and base.get_commit(oid).tree)
+            tree_from = oid and base.get_commit(oid).tree
     else:
-        tree_to = base.get_working_tree()
+        tree_to = base.get_working_tree(args.jobs)
         if not args.commit:
             # If no commit is specified, show the diff between the working tree and the index
             tree_from = base.get_index_tree()
 
-    result = diff.diff_trees(tree_from, tree_to)
+    result = diff.diff_trees(tree_from, tree_to, working_tree=not args.cached)
     sys.stdout.flush()
     sys.stdout.buffer.write(result)
 
 
 def checkout(args):
     """Checkout the specified commit by its object ID."""
-    base.checkout(args.commit)
+    base.checkout(args.commit, args.jobs)
 
 
 def create_tag(args):
@@ -277,7 +328,7 @@ def branch(args):
 
 def merge(args):
     """Merge the specified commit into the current branch."""
-    base.merge(args.commit)
+    base.merge(args.commit, args.jobs)
 
 
 def merge_base(args):
@@ -287,7 +338,7 @@ def merge_base(args):
 
 def fetch(args):
     """Fetch changes from a remote repository."""
-    remote.fetch(args.remote)
+    remote.fetch(args.remote, args.depth, args.shallow_exclude, args.filter_spec)
 
 
 def push(args):
@@ -314,16 +365,68 @@ def status(args):
 
     print('\nChanges to be committed:\n')
     HEAD_tree = HEAD and base.get_commit(HEAD).tree
-    for path, action in diff.iter_changed_files(base.get_tree(HEAD_tree), base.get_index_tree()):
+    for path, action in diff.iter_changed_files(HEAD_tree, base.get_index_tree()):
         print(f'    {action:>12}: {path}')
 
-    for path, action in diff.iter_changed_files(base.get_tree(HEAD_tree), base.get_working_tree()):
+    for path, action in diff.iter_changed_files(HEAD_tree, base.get_working_tree(args.jobs)):
         print(f'    {action:>12}: {path}')
 
 
 def add(args):
     """Add file contents to the index."""
-    base.add(args.files)
+    base.add(args.files, args.jobs)
+
+
+def config(args):
+    """Print a repository option, or set it if a value is given."""
+    if args.value is None:
+        value = data.get_config(args.key)
+        if value is not None:
+            print(value)
+    else:
+        data.set_config(args.key, args.value)
+
+
+
+def migrate_objects(args):
+    """Move loose objects into the fan-out directory layout."""
+    print(f'Migrated {data.migrate_objects()} objects')
+
+
+def pack_refs(args):
+    """Move loose refs into the packed-refs file."""
+    print(f'Packed {data.pack_refs()} refs')
+
+
+def repack(args):
+    """Pack all reachable objects into a single pack."""
+    print(f'Wrote {base.repack()}.pack')
+
+
+def gc(args):
+    """Repack reachable objects and prune unreachable ones."""
+    prune_expire = args.prune
+    if prune_expire is None:
+        prune_expire = int(data.get_config('gc.pruneExpire', 14 * 24 * 60 * 60))
+    data.pack_refs()
+    print(f'Wrote {base.repack(prune_expire)}.pack')
+
+
+def serve(args):
+    """Serve the repository to remote clients until interrupted."""
+    server.serve(args.url, lambda: print(f'Serving {os.getcwd()} on {args.url}', file=sys.stderr))
+
+
+def sparse_checkout(args):
+    """Check out only the given directories, list them, or check out everything again."""
+    if args.disable:
+        base.sparse_checkout(None, args.jobs)
+    elif args.dirs:
+        base.sparse_checkout(args.dirs, args.jobs)
+    else:
+        cone = sparse.load()
+        for dirname in sorted(cone.dirnames if cone else []):
+            print(dirname)
 
 
 if __name__ == '__main__':
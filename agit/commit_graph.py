@@ -0,0 +1,288 @@
+"""Commit-graph: precomputed parents, trees and generation numbers of commits.
+
+The graph is a chain of layer files under objects/info/commit-graphs, listed
+base first in commit-graph-chain. A layer holds a header, a 256-entry
+fan-out table, its sorted binary oids and a fixed-width record per commit:
+tree oid, two parent positions and generation number. Positions are global
+across the chain, so a layer numbers its commits after all lower layers'.
+Commits with more than two parents keep the rest in an extra edges list.
+
+New commits are written as a new layer, merged with the layers below it
+while those are less than twice its size, so updates stay cheap and the
+chain stays short. The graph is closed under parents: a commit is only
+added together with all of its ancestors.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+
+from . import data
+from . import pack
+
+
+SIGNATURE = b'ACGR'
+VERSION = 1
+
+NO_PARENT = 0xffffffff
+# In a record's second parent slot, marks an index into the extra edges
+# list; in that list, marks the last parent of a commit
+EDGE_FLAG = 0x80000000
+
+# Generation of commits missing from the graph, above any real generation
+GENERATION_INFINITY = 0xffffffff
+
+_HEADER = struct.Struct('>4sIIII')
+_FANOUT = struct.Struct('>256I')
+_RECORD = struct.Struct('>20sIII')
+_EDGE = struct.Struct('>I')
+
+_graph_cache = {}
+
+
+class GraphLayer:
+    """One memory-mapped layer of the commit-graph chain."""
+
+    def __init__(self, name, base_count):
+        self.name = name
+        path = os.path.join(_graph_dir(), f'graph-{name}.graph')
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, count, self.base_count, _ = _HEADER.unpack_from(self._map)
+        if signature != SIGNATURE or version != VERSION or self.base_count != base_count:
+            raise ValueError(f'Unsupported commit-graph layer {path}')
+
+        self._fanout = _FANOUT.unpack_from(self._map, _HEADER.size)
+        self._oids_at = _HEADER.size + _FANOUT.size
+        self._records_at = self._oids_at + 20 * count
+        self._edges_at = self._records_at + _RECORD.size * count
+
+    def __len__(self):
+        return self._fanout[-1]
+
+    def find(self, oid):
+        """Return the position of an oid within this layer, or None."""
+        return pack.bisect_oid(self._map, self._oids_at, self._fanout, oid)
+
+    def oid_at(self, pos):
+        """Return the oid at a position within this layer."""
+        at = self._oids_at + 20 * pos
+        return self._map[at:at + 20].hex()
+
+    def record_at(self, pos):
+        """Return (tree, parent positions, generation) at a position within this layer."""
+        tree, parent1, parent2, generation = _RECORD.unpack_from(self._map, self._records_at + _RECORD.size * pos)
+        parents = [] if parent1 == NO_PARENT else [parent1]
+        if parent2 & EDGE_FLAG and parent2 != NO_PARENT:
+            at = self._edges_at + _EDGE.size * (parent2 & ~EDGE_FLAG)
+            while True:
+                edge = _EDGE.unpack_from(self._map, at)[0]
+                parents.append(edge & ~EDGE_FLAG)
+                if edge & EDGE_FLAG:
+                    break
+                at += _EDGE.size
+        elif parent2 != NO_PARENT:
+            parents.append(parent2)
+        return tree.hex(), parents, generation
+
+
+class CommitGraph:
+    """A chain of commit-graph layers, addressed by global commit positions."""
+
+    def __init__(self, layers):
+        self.layers = layers
+
+    def __len__(self):
+        return sum(len(layer) for layer in self.layers)
+
+    def __contains__(self, oid):
+        return self.position(oid) is not None
+
+    def position(self, oid):
+        """Return the global position of a commit, or None if it is not in the graph."""
+        for layer in reversed(self.layers):
+            pos = layer.find(oid)
+            if pos is not None:
+                return layer.base_count + pos
+        return None
+
+    def _locate(self, pos):
+        """Return the layer holding a global position and the position within it."""
+        for layer in reversed(self.layers):
+            if pos >= layer.base_count:
+                return layer, pos - layer.base_count
+        raise IndexError(pos)
+
+    def oid_at(self, pos):
+        layer, pos = self._locate(pos)
+        return layer.oid_at(pos)
+
+    def record_at(self, pos):
+        layer, pos = self._locate(pos)
+        return layer.record_at(pos)
+
+    def get_parents(self, oid):
+        """Return the parent oids of a commit, or None if it is not in the graph."""
+        pos = self.position(oid)
+        if pos is None:
+            return None
+        return [self.oid_at(parent) for parent in self.record_at(pos)[1]]
+
+    def get_tree(self, oid):
+        """Return the tree oid of a commit, or None if it is not in the graph."""
+        pos = self.position(oid)
+        return None if pos is None else self.record_at(pos)[0]
+
+    def get_generation(self, oid):
+        """Return the generation number of a commit, or GENERATION_INFINITY if it is not in the graph."""
+        pos = self.position(oid)
+        return GENERATION_INFINITY if pos is None else self.record_at(pos)[2]
+
+
+def _graph_dir():
+    return os.path.join(data.GIT_DIR, 'objects', 'info', 'commit-graphs')
+
+
+def load():
+    """Load the repository's commit-graph, or an empty one if it has none.
+
+    The graph is cached per repository and only reloaded when its chain
+    file changes. A chain with missing or invalid layers counts as empty.
+    """
+    chain_path = os.path.join(_graph_dir(), 'commit-graph-chain')
+    try:
+        st = os.stat(chain_path)
+        stamp = st.st_mtime_ns, st.st_ino
+    except FileNotFoundError:
+        return CommitGraph([])
+
+    cached = _graph_cache.get(data.GIT_DIR)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    layers = []
+    try:
+        with open(chain_path) as f:
+            for name in f.read().split():
+                base_count = sum(len(layer) for layer in layers)
+                layers.append(GraphLayer(name, base_count))
+    except (OSError, ValueError):
+        layers = []
+
+    graph = CommitGraph(layers)
+    _graph_cache[data.GIT_DIR] = stamp, graph
+    return graph
+
+
+def clear():
+    """Drop the commit-graph, for when the parents it recorded are no longer right."""
+    graph_dir = _graph_dir()
+    try:
+        os.remove(os.path.join(graph_dir, 'commit-graph-chain'))
+    except FileNotFoundError:
+        return
+    for filename in os.listdir(graph_dir):
+        if filename.endswith('.graph'):
+            os.remove(os.path.join(graph_dir, filename))
+    _graph_cache.pop(data.GIT_DIR, None)
+
+
+def write(commits):
+    """Add commits to the commit-graph as a new layer.
+
+    commits maps oid -> (tree, parent oids) and must hold every ancestor
+    that is not in the graph yet. Does nothing if another process is
+    updating the graph at the same time, as the graph is only a cache.
+    """
+    graph_dir = _graph_dir()
+    os.makedirs(graph_dir, exist_ok=True)
+    lock_path = os.path.join(graph_dir, 'commit-graph-chain.lock')
+    try:
+        os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return
+
+    try:
+        graph = load()
+        layers = list(graph.layers)
+        merged = dict(commits)
+        while layers and 2 * len(merged) > len(layers[-1]):
+            layer = layers.pop()
+            for pos in range(len(layer)):
+                tree, parents, _ = layer.record_at(pos)
+                merged[layer.oid_at(pos)] = tree, [graph.oid_at(parent) for parent in parents]
+
+        chain = [layer.name for layer in layers]
+        chain.append(_write_layer(graph_dir, merged, CommitGraph(layers)))
+
+        fd, tmp_path = tempfile.mkstemp(dir=graph_dir, prefix='tmp_chain_')
+        data.make_read_only(fd)
+        with os.fdopen(fd, 'w') as f:
+            f.write(''.join(f'{name}\n' for name in chain))
+        os.replace(tmp_path, os.path.join(graph_dir, 'commit-graph-chain'))
+
+        # Drop layers that were merged away
+        for filename in os.listdir(graph_dir):
+            if filename.endswith('.graph') and filename[len('graph-'):-len('.graph')] not in chain:
+                os.remove(os.path.join(graph_dir, filename))
+    finally:
+        os.remove(lock_path)
+
+
+def _write_layer(graph_dir, commits, lower):
+    """Write commits as a layer on top of the lower graph, returning its name."""
+    oids = sorted(commits)
+    positions = {oid: len(lower) + i for i, oid in enumerate(oids)}
+
+    def get_position(oid):
+        pos = positions[oid] if oid in positions else lower.position(oid)
+        if pos is None:
+            raise ValueError(f'Parent {oid} is missing from the commit-graph')
+        return pos
+
+    generations = {}
+    for oid in oids:
+        stack = [oid]
+        while stack:
+            current = stack[-1]
+            parents = commits[current][1]
+            pending = [parent for parent in parents if parent in commits and parent not in generations]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            generations[current] = 1 + max(
+                (generations[parent] if parent in commits else lower.get_generation(parent) for parent in parents),
+                default=0)
+
+    records, edges = [], []
+    for oid in oids:
+        tree, parents = commits[oid]
+        parent_positions = [get_position(parent) for parent in parents]
+        parent1 = parent_positions[0] if parent_positions else NO_PARENT
+        if len(parent_positions) > 2:
+            parent2 = EDGE_FLAG | len(edges)
+            edges.extend(parent_positions[1:-1])
+            edges.append(parent_positions[-1] | EDGE_FLAG)
+        else:
+            parent2 = parent_positions[1] if len(parent_positions) == 2 else NO_PARENT
+        records.append(_RECORD.pack(bytes.fromhex(tree), parent1, parent2, generations[oid]))
+
+    content = b''.join([
+        _HEADER.pack(SIGNATURE, VERSION, len(oids), len(lower), len(edges)),
+        _FANOUT.pack(*pack.build_fanout(oids)),
+        b''.join(bytes.fromhex(oid) for oid in oids),
+        b''.join(records),
+        b''.join(_EDGE.pack(edge) for edge in edges),
+    ])
+    name = hashlib.sha1(content).hexdigest()
+
+    fd, tmp_path = tempfile.mkstemp(dir=graph_dir, prefix='tmp_graph_')
+    data.make_read_only(fd)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(content)
+        f.write(bytes.fromhex(name))
+    os.replace(tmp_path, os.path.join(graph_dir, f'graph-{name}.graph'))
+    return name
@@ -1,15 +1,104 @@
 import os
 import hashlib
+import itertools
 import shutil
 import json
+import mmap
+import tempfile
+import threading
+import time
+import zlib
 
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 from contextlib import contextmanager
 
+from . import bitmap
+from . import index
+from . import pack
+from . import protocol
+
 
 # Will be initialized by the `cli.main()` function
 GIT_DIR = None
 RefValue = namedtuple('RefValue', ['symbolic', 'value'])
+IndexEntry = index.IndexEntry
+
+# Files modified this close to an index write may change again within the
+# same filesystem timestamp tick without their stat data changing.
+RACY_WINDOW_NS = 2 * 10**9
+
+# The umask, read once at import as reading it means setting it
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+
+# Objects are hashed, stored and read back in chunks of this size
+CHUNK_SIZE = 1 << 20
+
+# Uncompressed objects start with their type name, zlib streams with this byte
+ZLIB_MAGIC = b'\x78'
+
+# Default memory budget of the parsed object cache, see 'core.objectCacheSize'
+OBJECT_CACHE_SIZE = 64 << 20
+
+_config_cache = {}
+# Per-repository (pack directory mtime, packs), see _get_packs
+_pack_cache = {}
+# Per-repository snapshots of ref values and loose ref names, see _read_ref
+_ref_cache = {}
+_ref_names_cache = {}
+_packed_refs_cache = {}
+_shallow_cache = {}
+object_cache = None
+
+
+class ObjectCache:
+    """A least recently used cache of parsed objects, bounded by a byte budget.
+
+    Entries are charged the size of the raw object they were parsed from.
+    Objects never change once written, so an entry is valid for as long as
+    it is kept. The cache is safe to share between threads.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for a key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        """Cache a value, evicting the least recently used ones over budget."""
+        if size > self.budget:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = value, size
+            self.size += size
+            self._evict()
+
+    def set_budget(self, budget):
+        """Change the memory budget, evicting entries as needed."""
+        with self._lock:
+            self.budget = budget
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.budget:
+            _, (_, size) = self._entries.popitem(last=False)
+            self.size -= size
 
 
 @contextmanager
@@ -23,56 +112,225 @@ def change_git_dir(new_dir):
 
 @contextmanager
 def get_index():
-    if os.path.isfile(f'{GIT_DIR}/index'):
-        with open(f'{GIT_DIR}/index') as f:
-            index = json.load(f)
-    
-    yield index
+    """Load the index as a path -> IndexEntry mapping, writing it back on exit if it changed.
+
+    The index lock is held from before reading until the index is written,
+    so that concurrent commands can't undo each other's changes. Raises
+    ValueError if another process holds it.
+    """
+    path = f'{GIT_DIR}/index'
+    lock_path = _create_lock(path)
+    try:
+        entries = index.Index(path)
+
+        yield entries
+
+        if entries.dirty:
+            # Racily clean entries lose their stat data so the next scan rehashes them
+            racy_since = time.time_ns() - RACY_WINDOW_NS
+            racy = [path for path, entry in entries.items() if entry.mtime_ns >= racy_since]
+            for path in racy:
+                entries[path] = make_index_entry(entries[path].oid)
+
+            # Moving the lock file into place releases the lock
+            entries.write(lock_path)
+            return
+    except BaseException:
+        os.remove(lock_path)
+        raise
+    os.remove(lock_path)
+
+
+def make_index_entry(oid, st=None):
+    """Build an index entry for an oid, recording the file's stat data if given."""
+    if st is None:
+        return IndexEntry(oid, 0, 0, 0, 0, 0)
+    return IndexEntry(oid, st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino, st.st_mode)
+
+
+def stat_matches(entry, st):
+    """Check whether an index entry's cached stat data still describes a file."""
+    return bool(entry.mtime_ns) and entry[1:] == make_index_entry(entry.oid, st)[1:]
 
-    with open(f'{GIT_DIR}/index', 'w') as f:
-        json.dump(index, f)
 
-        
 def init():
     """Initialize a new Git-like repository structure."""
     os.makedirs(os.path.join(GIT_DIR, 'objects'), exist_ok=True)
     os.makedirs(os.path.join(GIT_DIR, 'refs'), exist_ok=True)
 
 
-def update_ref(ref, value, deref=True):
-    """Update a reference with the given object ID."""
-    ref = _get_ref_internal(ref, deref)[0]
+def _load_config():
+    """Load the repository config, caching it per repository for this process."""
+    if GIT_DIR not in _config_cache:
+        config = {}
+        if os.path.isfile(f'{GIT_DIR}/config'):
+            with open(f'{GIT_DIR}/config') as f:
+                config = json.load(f)
+        _config_cache[GIT_DIR] = config
+    return _config_cache[GIT_DIR]
+
+
+def get_config(key, default=None):
+    """Retrieve a repository config value such as 'core.compression'."""
+    return _load_config().get(key, default)
 
-    assert value.value
-    if value.symbolic:
-        value = f'ref: {value.value}'
-    else:
-        value = value.value
 
-    ref_path = os.path.join(GIT_DIR, ref)
-    os.makedirs(os.path.dirname(ref_path), exist_ok=True)
-    with open(ref_path, 'w') as f:
-        f.write(value)
+def set_config(key, value):
+    """Store a repository config value."""
+    config = _load_config()
+    config[key] = value
+    with open(f'{GIT_DIR}/config', 'w') as f:
+        json.dump(config, f, indent=2, sort_keys=True)
+
+
+def update_ref(ref, value, deref=True):
+    """Update a reference with the given object ID."""
+    with ref_transaction() as transaction:
+        transaction.update(ref, value, deref=deref)
 
 
 def get_ref(ref, deref=True):
     """Retrieve the object ID associated with a given reference."""
-    return _get_ref_internal(ref)[1]
+    return _get_ref_internal(ref, deref)[1]
 
 
 def delete_ref(ref, deref=True):
-    """Delete a reference."""
-    ref = _get_ref_internal(ref, deref)[0]
-    os.remove(os.path.join(GIT_DIR, ref))
-    
+    """Delete a reference, both its loose file and its packed-refs line."""
+    with ref_transaction() as transaction:
+        transaction.delete(ref, deref=deref)
+
+
+# Default for a transaction's expected old value, to not check it
+_ANY_VALUE = object()
+
+# Characters refnames may not hold, as with `git check-ref-format`
+_REFNAME_FORBIDDEN = set(' ~^:?*[\\') | {chr(c) for c in range(32)} | {'\x7f'}
+
+
+def check_refname(ref):
+    """Raise ValueError unless a refname is well formed and stays within GIT_DIR.
+
+    Like `git check-ref-format`, components may not be empty, start with
+    '.' or end with '.lock', and the name may not hold '..', '@{' or
+    control and special characters.
+    """
+    if (not ref or '..' in ref or '@{' in ref or ref.endswith('.')
+            or _REFNAME_FORBIDDEN.intersection(ref)
+            or any(not part or part.startswith('.') or part.endswith('.lock') for part in ref.split('/'))):
+        raise ValueError(f'Invalid refname {ref!r}')
+
+
+class RefTransaction:
+    """A batch of ref updates applied all together or not at all.
+
+    Each update may name the value it expects the ref to have, None meaning
+    that it must not exist yet. commit locks every ref, checks the expected
+    values, writes and syncs the new values next to the refs, and only then
+    renames them all into place. If a lock is held by another process or a
+    ref has moved, nothing is changed and ValueError is raised.
+    """
+
+    def __init__(self):
+        # ref -> (raw new value or None to delete, expected old value)
+        self.updates = {}
+
+    def update(self, ref, value, old=_ANY_VALUE, deref=True):
+        """Queue setting a ref to a RefValue, raising ValueError if a refname is invalid."""
+        assert value.value
+        check_refname(ref)
+        ref = _get_ref_internal(ref, deref)[0]
+        check_refname(ref)
+        if value.symbolic:
+            check_refname(value.value)
+        self.updates[ref] = f'ref: {value.value}' if value.symbolic else value.value, old
+
+    def delete(self, ref, old=_ANY_VALUE, deref=True):
+        """Queue deleting a ref, both its loose file and its packed-refs line."""
+        check_refname(ref)
+        ref = _get_ref_internal(ref, deref)[0]
+        check_refname(ref)
+        self.updates[ref] = None, old
+
+    def commit(self):
+        locks = {}
+        try:
+            for ref in sorted(self.updates):
+                ref_path = os.path.join(GIT_DIR, ref)
+                os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+                locks[ref] = _create_lock(ref_path)
+
+            # Check against the refs as they are now, not as this process last saw them
+            clear_ref_cache()
+            for ref, (_, old) in self.updates.items():
+                current = _read_ref(ref)
+                if old is not _ANY_VALUE and current != old:
+                    raise ValueError(f'Ref {ref} is at {current}, expected {old}')
+
+            packed_deletes = {ref for ref, (value, _) in self.updates.items()
+                              if value is None and _find_packed_ref(ref)}
+            packed_lock = None
+            if packed_deletes:
+                packed_lock = _create_lock(os.path.join(GIT_DIR, 'packed-refs'))
+                locks['packed-refs'] = packed_lock
+                _write_lock(packed_lock, ''.join(
+                    f'{oid} {ref}\n' for ref, oid in _iter_packed_refs() if ref not in packed_deletes))
+
+            for ref, (value, _) in self.updates.items():
+                if value is not None:
+                    _write_lock(locks[ref], value)
+        except BaseException:
+            for lock_path in locks.values():
+                os.remove(lock_path)
+            raise
+
+        # Every ref is locked and verified, so nothing else can move them now
+        if packed_lock:
+            os.replace(packed_lock, os.path.join(GIT_DIR, 'packed-refs'))
+        for ref, (value, _) in self.updates.items():
+            ref_path = os.path.join(GIT_DIR, ref)
+            if value is None:
+                try:
+                    os.remove(ref_path)
+                except FileNotFoundError:
+                    pass
+                os.remove(locks[ref])
+            else:
+                os.replace(locks[ref], ref_path)
+        clear_ref_cache()
+
+
+@contextmanager
+def ref_transaction():
+    """Collect ref updates in a RefTransaction and commit them on exit."""
+    transaction = RefTransaction()
+    yield transaction
+    transaction.commit()
+
+
+def _create_lock(path):
+    """Take the lock file of a path, returning the lock's path.
+
+    Raises ValueError if another process holds it.
+    """
+    lock_path = f'{path}.lock'
+    try:
+        os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+    except FileExistsError:
+        raise ValueError(f'{lock_path} is locked by another process, remove it if it is not')
+    return lock_path
+
+
+def _write_lock(lock_path, content):
+    """Write and sync the new content of a locked file."""
+    with open(lock_path, 'w') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+
 
 def _get_ref_internal(ref, deref):
     """Retrieve the object ID associated with a given reference."""
-    ref_path = os.path.join(GIT_DIR, ref)
-    value = None
-    if os.path.isfile(ref_path):
-        with open(ref_path) as f:
-            value = f.read().strip()
+    value = _read_ref(ref)
     
     symbolic = bool(value) and value.startswith('ref:')
     if symbolic:
@@ -80,45 +338,564 @@ def _get_ref_internal(ref, deref):
         if deref:
             return _get_ref_internal(value, deref=True)
     
-    return ref, RefValue(symbolic=False, value=value)
+    return ref, RefValue(symbolic=symbolic, value=value)
+
+
+def _read_ref(ref):
+    """Return the raw value of a ref, or None if it doesn't exist.
+
+    Loose ref files take precedence over packed-refs. Values are kept in a
+    per-process snapshot, which only this process's ref updates change.
+    """
+    cache = _ref_cache.setdefault(GIT_DIR, {})
+    if ref not in cache:
+        ref_path = os.path.join(GIT_DIR, ref)
+        if os.path.isfile(ref_path):
+            with open(ref_path) as f:
+                cache[ref] = f.read().strip()
+        else:
+            cache[ref] = _find_packed_ref(ref)
+    return cache[ref]
+
+
+def clear_ref_cache():
+    """Forget the ref snapshot, so refs changed by other processes are read again."""
+    _ref_cache.pop(GIT_DIR, None)
+    _ref_names_cache.pop(GIT_DIR, None)
+    _packed_refs_cache.pop(GIT_DIR, None)
+
+
+def _get_packed_refs():
+    """Return the mapped packed-refs file, or b'' if there is none."""
+    if GIT_DIR not in _packed_refs_cache:
+        buf = b''
+        try:
+            with open(os.path.join(GIT_DIR, 'packed-refs'), 'rb') as f:
+                if os.fstat(f.fileno()).st_size:
+                    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            pass
+        _packed_refs_cache[GIT_DIR] = buf
+    return _packed_refs_cache[GIT_DIR]
+
+
+def _find_packed_ref(ref):
+    """Binary search packed-refs for a ref, returning its oid or None.
+
+    The file holds one '<oid> <ref>' line per ref, sorted by ref.
+    """
+    buf = _get_packed_refs()
+    key = ref.encode()
+    lo, hi = 0, len(buf)
+    while lo < hi:
+        # Look at the line around the midpoint; lo and hi stay on line starts
+        start = buf.rfind(b'\n', lo, (lo + hi) // 2) + 1 or lo
+        end = buf.find(b'\n', start, hi)
+        if end == -1:
+            end = hi
+        name = buf[start + 41:end]
+        if name == key:
+            return buf[start:start + 40].decode()
+        if name < key:
+            lo = end + 1
+        else:
+            hi = start
+    return None
 
 
-def hash_object(data, type_='blob'):
-    """Hash the given data and store it in the objects directory."""
+def _iter_packed_refs():
+    """Yield the (ref, oid) pairs of packed-refs in order."""
+    for line in _get_packed_refs()[:].splitlines():
+        yield line[41:].decode(), line[:40].decode()
+
+
+def pack_refs():
+    """Move all loose refs under refs/ into packed-refs, returning how many were packed.
+
+    Symbolic refs stay loose. packed-refs is locked while it is read and
+    rewritten, then each loose ref is locked and only removed if it still
+    has the value that was packed, like a RefTransaction would; refs being
+    updated meanwhile stay loose.
+    """
+    packed_refs_path = os.path.join(GIT_DIR, 'packed-refs')
+    packed_lock = _create_lock(packed_refs_path)
+    try:
+        # Read everything afresh now that no transaction can change packed-refs
+        clear_ref_cache()
+        refs = dict(_iter_packed_refs())
+        packed = {}
+        for ref in _iter_loose_ref_names():
+            value = _read_ref(ref)
+            if value and not value.startswith('ref:'):
+                refs[ref] = packed[ref] = value
+        _write_lock(packed_lock, ''.join(f'{refs[ref]} {ref}\n' for ref in sorted(refs)))
+    except BaseException:
+        os.remove(packed_lock)
+        raise
+    os.replace(packed_lock, packed_refs_path)
+
+    for ref, value in packed.items():
+        ref_path = os.path.join(GIT_DIR, ref)
+        try:
+            lock_path = _create_lock(ref_path)
+        except ValueError:
+            # Being updated, so it stays loose
+            continue
+        try:
+            with open(ref_path) as f:
+                if f.read().strip() != value:
+                    continue
+            os.remove(ref_path)
+        except FileNotFoundError:
+            continue
+        finally:
+            os.remove(lock_path)
+
+        # Drop directories left empty, up to refs/ itself
+        dirname = os.path.dirname(ref)
+        while dirname != 'refs':
+            try:
+                os.rmdir(os.path.join(GIT_DIR, dirname))
+            except OSError:
+                break
+            dirname = os.path.dirname(dirname)
+    clear_ref_cache()
+    return len(packed)
+
+
+def get_shallow():
+    """Return the boundary commits of a shallow repository, whose parents it lacks.
+
+    They are listed one per line in the shallow file, which only exists in
+    shallow repositories, and read once per process.
+    """
+    if GIT_DIR not in _shallow_cache:
+        try:
+            with open(os.path.join(GIT_DIR, 'shallow')) as f:
+                _shallow_cache[GIT_DIR] = frozenset(f.read().split())
+        except FileNotFoundError:
+            _shallow_cache[GIT_DIR] = frozenset()
+    return _shallow_cache[GIT_DIR]
+
+
+def write_shallow(oids):
+    """Replace the boundary commits, making the repository whole if there are none."""
+    path = os.path.join(GIT_DIR, 'shallow')
+    lock_path = _create_lock(path)
+    try:
+        if oids:
+            _write_lock(lock_path, ''.join(f'{oid}\n' for oid in sorted(oids)))
+            os.replace(lock_path, path)
+        else:
+            os.remove(lock_path)
+            if os.path.exists(path):
+                os.remove(path)
+    except BaseException:
+        if os.path.exists(lock_path):
+            os.remove(lock_path)
+        raise
+    _shallow_cache[GIT_DIR] = frozenset(oids)
+
+
+def hash_object(data, type_='blob', write=True):
+    """Hash the given data and store it in the objects directory.
+
+    With write=False only the oid is computed. Objects are immutable, so an
+    object that is already stored is never rewritten.
+    """
     obj = f"{type_}\x00".encode() + data
     oid = hashlib.sha1(obj).hexdigest()
-    object_path = os.path.join(GIT_DIR, 'objects', oid)
-    with open(object_path, 'wb') as out:
-        out.write(obj)
+    if write:
+        _write_object([obj], oid)
+    return oid
+
+
+def hash_file(path, type_='blob', write=True):
+    """Hash a file, streaming it in chunks unless it is small enough to read at once."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < CHUNK_SIZE:
+            return hash_object(f.read(), type_, write)
+        return hash_stream(f, type_, write)
+
+
+def hash_stream(f, type_='blob', write=True):
+    """Hash a binary stream chunk by chunk, storing it unless write is False."""
+    chunks = itertools.chain([f'{type_}\x00'.encode()], iter(lambda: f.read(CHUNK_SIZE), b''))
+    if write:
+        return _write_object(chunks)
+
+    sha = hashlib.sha1()
+    for chunk in chunks:
+        sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _write_object(chunks, oid=None, skip_existing=True):
+    """Write an object through a temp file that is atomically renamed into place.
+
+    If the oid is not known up front it is computed from the chunks as they
+    are written. Objects are deflated at the 'core.compression' level, where
+    0 stores them uncompressed. An object that is already stored, loose or
+    packed, is left alone unless skip_existing is False.
+    """
+    if oid and skip_existing and object_exists(oid):
+        return oid
+
+    objects_dir = os.path.join(GIT_DIR, 'objects')
+    sha = hashlib.sha1() if oid is None else None
+    level = int(get_config('core.compression', zlib.Z_DEFAULT_COMPRESSION))
+    deflater = zlib.compressobj(level) if level else None
+    fd, tmp_path = tempfile.mkstemp(dir=objects_dir, prefix='tmp_obj_')
+    make_read_only(fd)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in chunks:
+                if sha:
+                    sha.update(chunk)
+                out.write(deflater.compress(chunk) if deflater else chunk)
+            if deflater:
+                out.write(deflater.flush())
+
+        if sha:
+            oid = sha.hexdigest()
+        # A known oid was already checked before writing
+        if not (sha and skip_existing and object_exists(oid)):
+            _move_into_place(tmp_path, oid)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
     return oid
 
 
+def make_read_only(fd):
+    """Make a new temp file readable by all the umask allows, and writable by none."""
+    os.fchmod(fd, 0o444 & ~_UMASK)
+
+
+def _object_path(oid):
+    """Return the fan-out path of a loose object, objects/ab/cdef..."""
+    return os.path.join(GIT_DIR, 'objects', oid[:2], oid[2:])
+
+
+def _find_object_path(oid):
+    """Locate a loose object in either the fan-out or the legacy flat layout."""
+    fanout_path = _object_path(oid)
+    flat_path = os.path.join(GIT_DIR, 'objects', oid)
+    # The fan-out path is checked again last in case a concurrent
+    # migrate-objects moved the object between the first two checks
+    for path in (fanout_path, flat_path, fanout_path):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def _move_into_place(tmp_path, oid):
+    """Atomically rename a fully written temp file to its object path."""
+    object_path = _object_path(oid)
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    os.replace(tmp_path, object_path)
+
+
+def _copy_object_file(src_path, oid):
+    """Copy a stored object file into this repository as object oid."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.join(GIT_DIR, 'objects'), prefix='tmp_obj_')
+    make_read_only(fd)
+    try:
+        with os.fdopen(fd, 'wb') as out, open(src_path, 'rb') as src:
+            shutil.copyfileobj(src, out)
+        _move_into_place(tmp_path, oid)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def migrate_objects():
+    """Move loose objects from the flat layout into fan-out directories.
+
+    Each object is hard-linked into its new place before the flat file is
+    removed, so concurrent readers always find it in one of the layouts.
+    """
+    migrated = 0
+    with os.scandir(os.path.join(GIT_DIR, 'objects')) as entries:
+        for entry in entries:
+            if len(entry.name) != 40 or not entry.is_file():
+                continue
+            object_path = _object_path(entry.name)
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            try:
+                os.link(entry.path, object_path)
+            except FileExistsError:
+                pass
+            except OSError:
+                # Filesystems without hard links get an atomic copy instead
+                _copy_object_file(entry.path, entry.name)
+            os.remove(entry.path)
+            migrated += 1
+    return migrated
+
+
 def get_object(oid, expected='blob'):
     """Retrieve the content of an object by its object ID."""
-    object_path = os.path.join(GIT_DIR, 'objects', oid)
-    with open(object_path, 'rb') as f:
-        obj = f.read()
-    
-    type_, _, content = obj.partition(b'\x00')
-    type_ = type_.decode()
+    return b''.join(iter_object(oid, expected))
+
+
+def iter_tree_entries(oid):
+    """Yield (type_, oid, name) entries from a tree object."""
+    if not oid:
+        return
+    yield from get_parsed_object(oid, 'tree', _parse_tree)
+
+
+def _parse_tree(tree):
+    """Parse the content of a tree object into (type_, oid, name) entries."""
+    return tuple(tuple(entry.split()) for entry in tree.decode().splitlines())
+
 
+def get_parsed_object(oid, expected, parse):
+    """Retrieve an object decoded by parse(content), through the object cache.
+
+    The cache is created on first use with a budget of 'core.objectCacheSize'
+    bytes.
+    """
+    global object_cache
+    if object_cache is None:
+        object_cache = ObjectCache(int(get_config('core.objectCacheSize', OBJECT_CACHE_SIZE)))
+
+    key = oid, expected
+    value = object_cache.get(key)
+    if value is None:
+        content = get_object(oid, expected)
+        value = parse(content)
+        object_cache.put(key, value, len(content))
+    return value
+
+
+def iter_object(oid, expected='blob'):
+    """Yield the content of an object in chunks instead of reading it whole."""
+    type_, chunks = _open_object(oid)
     if expected is not None:
         assert type_ == expected, f'Expected {expected}, got {type_}'
-    
-    return content
+
+    yield from chunks
+
+
+def _open_object(oid):
+    """Return an object's type and an iterator over its content chunks."""
+    chunks = _iter_object_bytes(oid)
+    obj = b''
+    for chunk in chunks:
+        obj += chunk
+        if b'\x00' in obj:
+            break
+
+    type_, _, content = obj.partition(b'\x00')
+    return type_.decode(), itertools.chain([content], chunks)
+
+
+def _iter_object_bytes(oid):
+    """Yield the stored bytes of an object, from a pack or a loose object file."""
+    packed = _find_packed(oid)
+    object_path = None if packed else _find_object_path(oid)
+    if not (packed or object_path):
+        # A concurrent repack may have moved the object into a new pack
+        packed = _find_packed(oid, rescan=True)
+    if packed:
+        pack_, offset = packed
+        yield from pack_.iter_object(offset)
+        return
+
+    try:
+        f = open(object_path or _object_path(oid), 'rb')
+    except FileNotFoundError:
+        # A concurrent repack may have packed and removed the loose object
+        packed = _find_packed(oid, rescan=True)
+        if not packed:
+            # Or it was left with the promisor remote of a partial clone
+            if not prefetch_objects([oid]):
+                raise
+            yield from _iter_object_bytes(oid)
+            return
+        pack_, offset = packed
+        yield from pack_.iter_object(offset)
+        return
+
+    with f:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk.startswith(ZLIB_MAGIC):
+            yield chunk
+            yield from iter(lambda: f.read(CHUNK_SIZE), b'')
+            return
+
+        # Bound each inflated piece so highly compressible blobs stay streamed
+        inflater = zlib.decompressobj()
+        while chunk:
+            yield inflater.decompress(chunk, CHUNK_SIZE)
+            while inflater.unconsumed_tail:
+                yield inflater.decompress(inflater.unconsumed_tail, CHUNK_SIZE)
+            chunk = f.read(CHUNK_SIZE)
+        yield inflater.flush()
+
+
+def _get_packs(rescan=False):
+    """Return the repository's packs, mapping any new ones when rescanning.
+
+    A rescan only lists the pack directory again if its mtime changed since
+    the last listing, so looking for missing objects stays cheap.
+    """
+    mtime, packs = _pack_cache.get(GIT_DIR, (None, []))
+    if rescan or GIT_DIR not in _pack_cache:
+        pack_dir = os.path.join(GIT_DIR, 'objects', 'pack')
+        try:
+            new_mtime = os.stat(pack_dir).st_mtime_ns
+        except FileNotFoundError:
+            new_mtime = None
+        if new_mtime is not None and new_mtime == mtime:
+            return packs
+        # A change within the same clock tick as the listing would go
+        # unnoticed, so a directory that recent is listed again next time
+        if new_mtime is not None and time.time_ns() - new_mtime < 1_000_000_000:
+            new_mtime = None
+
+        packs = {pack_.path: pack_ for pack_ in packs}
+        names = os.listdir(pack_dir) if os.path.isdir(pack_dir) else []
+        for name in sorted(names):
+            path = os.path.join(pack_dir, name[:-len('.idx')])
+            if name.endswith('.idx') and path not in packs:
+                try:
+                    packs[path] = pack.Pack(path)
+                except FileNotFoundError:
+                    # Removed by a concurrent repack since we listed it
+                    pass
+        packs = [packs[path] for path in sorted(packs) if os.path.isfile(f'{path}.idx')]
+        _pack_cache[GIT_DIR] = new_mtime, packs
+    return packs
+
+
+def get_pack(path):
+    """Return the repository's pack at a path, without extension."""
+    for pack_ in _get_packs(rescan=True):
+        if pack_.path == path:
+            return pack_
+    raise ValueError(f'Unknown pack {path}')
+
+
+def get_bitmaps():
+    """Return the reachability bitmaps of the first pack that has them, or None."""
+    for pack_ in _get_packs():
+        bitmaps = bitmap.load(pack_)
+        if bitmaps:
+            return bitmaps
+    return None
+
+
+def _find_packed(oid, rescan=False):
+    """Find an object in the repository's packs, returning (pack, offset) or None."""
+    for pack_ in _get_packs(rescan):
+        offset = pack_.index.find(oid)
+        if offset is not None:
+            return pack_, offset
+    return None
+
+
+def write_pack(objects):
+    """Copy objects into a new pack, returning its path.
+
+    objects lists (oid, type_, name) tuples, where name is the path the
+    object was found at. Objects are grouped by type and file name, keeping
+    their given order otherwise, and stored as deltas against similar
+    neighbours within the 'pack.window' and 'pack.depth' limits.
+    """
+    type_order = {'commit': 0, 'tree': 1, 'blob': 2}
+    objects = sorted(objects, key=lambda obj: (type_order[obj[1]], os.path.basename(obj[2]), obj[2]))
+
+    def iter_objects():
+        for oid, type_, _ in objects:
+            yield oid, type_, _open_object(oid)[1]
+
+    window = int(get_config('pack.window', 10))
+    depth = int(get_config('pack.depth', 50))
+    level = int(get_config('core.compression', zlib.Z_DEFAULT_COMPRESSION))
+    entries = pack.deltify(iter_objects(), window, depth)
+    path = pack.write_pack(os.path.join(GIT_DIR, 'objects', 'pack'), entries, level)
+    _get_packs(rescan=True)
+    return path
+
+
+def repack(objects, prune_expire=None):
+    """Replace all packs with a single pack holding the given objects.
+
+    objects is passed on to write_pack(). Loose copies of packed objects
+    are removed. Objects that were only in the old packs are turned back
+    into loose objects, so that like any other loose object they are only
+    deleted by a prune once older than prune_expire seconds.
+    """
+    old_packs = _get_packs(rescan=True)
+    path = write_pack(objects)
+    keep = {oid for oid, _, _ in objects}
+    cutoff = None if prune_expire is None else time.time() - prune_expire
+
+    for pack_ in old_packs:
+        if pack_.path == path:
+            continue
+        mtime = os.stat(f'{pack_.path}.pack').st_mtime
+        if cutoff is None or mtime >= cutoff:
+            for oid in pack_.index.iter_oids():
+                if oid in keep or _find_object_path(oid):
+                    continue
+                _write_object(pack_.iter_object(pack_.index.find(oid)), oid, skip_existing=False)
+                os.utime(_object_path(oid), (mtime, mtime))
+        # Readers find packs through their index, so it goes first
+        if os.path.exists(f'{pack_.path}.bitmap'):
+            os.remove(f'{pack_.path}.bitmap')
+        os.remove(f'{pack_.path}.idx')
+        os.remove(f'{pack_.path}.pack')
+
+    emptied_dirs = set()
+    for oid, object_path in list(iter_loose_objects()):
+        if oid in keep or (cutoff is not None and os.stat(object_path).st_mtime < cutoff):
+            os.remove(object_path)
+            emptied_dirs.add(os.path.dirname(object_path))
+
+    for dirname in emptied_dirs:
+        try:
+            os.rmdir(dirname)
+        except OSError:
+            # Still holds other loose objects, or is the objects dir itself
+            pass
+
+    if cutoff is not None:
+        # Temp files left behind by interrupted writes
+        for dirname in (os.path.join(GIT_DIR, 'objects'), os.path.join(GIT_DIR, 'objects', 'pack')):
+            for name in os.listdir(dirname):
+                tmp_path = os.path.join(dirname, name)
+                if name.startswith('tmp_') and os.stat(tmp_path).st_mtime < cutoff:
+                    os.remove(tmp_path)
+
+    _get_packs(rescan=True)
+    return path
+
+
+def iter_loose_objects():
+    """Yield (oid, path) for every loose object, in either layout."""
+    with os.scandir(os.path.join(GIT_DIR, 'objects')) as entries:
+        for entry in entries:
+            if len(entry.name) == 40 and entry.is_file():
+                yield entry.name, entry.path
+            elif len(entry.name) == 2 and entry.is_dir():
+                with os.scandir(entry.path) as subentries:
+                    for subentry in subentries:
+                        if len(subentry.name) == 38:
+                            yield entry.name + subentry.name, subentry.path
 
 
 def iter_refs(prefix='', deref=True):
-    """Iterate over references in the repository."""
-    refs = ['HEAD', 'MERGE_HEAD']
-    refs_dir = os.path.join(GIT_DIR, 'refs')
-    
-    for root, _, filenames in os.walk(refs_dir):
-        for name in filenames:
-            ref_path = os.path.relpath(os.path.join(root, name), GIT_DIR)
-            refs.append(ref_path)
-    
-    for refname in refs:
+    """Iterate over references in the repository, loose or packed."""
+    if GIT_DIR not in _ref_names_cache:
+        names = set(_iter_loose_ref_names())
+        names.update(name for name, _ in _iter_packed_refs())
+        _ref_names_cache[GIT_DIR] = ['HEAD', 'MERGE_HEAD'] + sorted(names)
+
+    for refname in _ref_names_cache[GIT_DIR]:
         if not refname.startswith(prefix):
             continue
         ref = get_ref(refname, deref=deref)
@@ -126,19 +903,138 @@ def iter_refs(prefix='', deref=True):
             yield refname, ref
         
 
+def _iter_loose_ref_names():
+    """Yield the names of the loose ref files under refs/."""
+    for root, _, filenames in os.walk(os.path.join(GIT_DIR, 'refs')):
+        for name in filenames:
+            # Lock files belong to ref updates in progress
+            if not name.endswith('.lock'):
+                yield os.path.relpath(os.path.join(root, name), GIT_DIR)
+
+
 def object_exists(oid):
     """Check if an object exists in the repository."""
-    return os.path.exists(os.path.join(GIT_DIR, 'objects', oid))
+    return bool(_find_packed(oid) or _find_object_path(oid) or _find_packed(oid, rescan=True))
+
+
+def fetch_objects(oids, remote_path, progress=None):
+    """Copy objects from a remote repository into this one, see _send_objects()."""
+    git_dir = GIT_DIR
+    with change_git_dir(remote_path):
+        _send_objects(oids, git_dir, progress)
+
+
+def prefetch_objects(oids):
+    """Fetch those of some objects a partial clone lacks, in one go.
+
+    Partial clones, made by fetching without blobs, name the remote they
+    got their other objects from in 'remote.promisor', which is trusted to
+    have the missing ones. Returns how many objects were fetched.
+    """
+    remote = get_config('remote.promisor')
+    if not remote:
+        return 0
+    missing = [oid for oid in dict.fromkeys(oids) if oid and not object_exists(oid)]
+    if not missing:
+        return 0
+
+    if protocol.is_url(remote):
+        with protocol.Connection(remote) as connection:
+            if connection.request({'command': 'get-objects', 'oids': missing})['count']:
+                receive_objects(connection.iter_pack())
+    else:
+        fetch_objects(missing, remote)
+    return len(missing)
+
+
+def push_objects(oids, remote_path, progress=None):
+    """Copy objects from this repository into a remote one, see _send_objects()."""
+    with change_git_dir(remote_path):
+        remote_git_dir = GIT_DIR
+    _send_objects(oids, remote_git_dir, progress)
 
 
-def fetch_object_if_missing(oid, remote_git_dir):
-    """Fetch an object from a remote repository if it is missing."""
-    if object_exists(oid):
+def _send_objects(oids, dst_git_dir, progress):
+    """Copy objects from this repository into the one at dst_git_dir.
+
+    On the same filesystem, loose objects and the packs holding nothing
+    but requested objects are hard-linked into place. The rest, or all of
+    them if linking fails, are streamed as a single pack that the receiving
+    side indexes as it arrives. progress is called with the number of
+    objects and bytes transferred so far.
+    """
+    oids = list(dict.fromkeys(oids))
+    if not oids:
         return
-    remote_git_dir += '/.agit'
-    shutil.copy(f'{remote_git_dir}/objects/{oid}', f'{GIT_DIR}/objects/{oid}')
 
+    dst_objects = os.path.join(dst_git_dir, 'objects')
+    linked = 0
+    if os.stat(os.path.join(GIT_DIR, 'objects')).st_dev == os.stat(dst_objects).st_dev:
+        try:
+            rest = _link_objects(oids, dst_objects, progress)
+            linked, oids = len(oids) - len(rest), rest
+        except OSError:
+            # Hard links may not be supported, copy instead
+            pass
+
+    if oids:
+        pack.index_pack(os.path.join(dst_objects, 'pack'), stream_objects(oids),
+                        progress and (lambda count, size: progress(linked + count, size)))
+
+
+def stream_objects(oids, progress=None):
+    """Yield a pack holding objects piece by piece, see pack.stream_pack()."""
+    level = int(get_config('core.compression', zlib.Z_DEFAULT_COMPRESSION))
+    yield from pack.stream_pack(((oid, *_open_object(oid)) for oid in oids), level, progress)
+
+
+def receive_objects(pieces, progress=None):
+    """Store a pack arriving as pieces of bytes, see pack.index_pack()."""
+    return pack.index_pack(os.path.join(GIT_DIR, 'objects', 'pack'), pieces, progress)
 
-def push_object(oid, remote_git_dir):
-    remote_git_dir += '/.agit'
-    shutil.copy(f'{GIT_DIR}/objects/{oid}', f'{remote_git_dir}/objects/{oid}')
\ No newline at end of file
+
+def _link_objects(oids, dst_objects, progress):
+    """Hard-link objects into another objects directory, returning those left to copy.
+
+    Loose objects are linked one by one. A pack is only linked whole if
+    every object in it is wanted, so that nothing else goes along, neither
+    blobs a partial clone left out nor objects not meant to be pushed.
+    """
+    # pack -> the wanted oids it holds
+    packed = {}
+    count = 0
+    for oid in oids:
+        object_path = _find_object_path(oid)
+        if not object_path:
+            found = _find_packed(oid) or _find_packed(oid, rescan=True)
+            if not found:
+                raise ValueError(f'Object {oid} not found')
+            packed.setdefault(found[0], []).append(oid)
+            continue
+        dst_path = os.path.join(dst_objects, oid[:2], oid[2:])
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        try:
+            os.link(object_path, dst_path)
+        except FileExistsError:
+            pass
+        count += 1
+        if progress:
+            progress(count, 0)
+
+    rest = []
+    os.makedirs(os.path.join(dst_objects, 'pack'), exist_ok=True)
+    for pack_, pack_oids in packed.items():
+        if len(pack_oids) < len(pack_.index):
+            rest.extend(pack_oids)
+            continue
+        dst_path = os.path.join(dst_objects, 'pack', os.path.basename(pack_.path))
+        # The index last, as pack._write_pack_file() moves them into place
+        for ext in ('.pack', '.idx'):
+            try:
+                os.link(f'{pack_.path}{ext}', f'{dst_path}{ext}')
+            except FileExistsError:
+                pass
+        count += len(pack_oids)
+        if progress:
+            progress(count, 0)
+    return rest
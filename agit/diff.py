@@ -1,71 +1,600 @@
-from collections import defaultdict
+import re
 import subprocess
 from tempfile import NamedTemporaryFile as Temp
 
 from . import data
 
 
+# Lines of context around each hunk, as with `diff --unified`
+CONTEXT_LINES = 3
+
+# Like `diff --show-c-function`, hunk headers name the last preceding line
+# that looks like the start of a function, cut to this many characters
+FUNCTION_RE = re.compile(rb'[A-Za-z$_]')
+FUNCTION_LINE_LENGTH = 40
+
+# Past this many edits from either end of a range, or the square root of
+# the lines compared if more, diff_lines settles for a script that may not
+# be the shortest, as GNU diff does
+MAX_EDIT_COST = 4096
+
+# The first marker of a conflict written by merge_blobs()
+CONFLICT_RE = re.compile(rb'^<<<<<<< HEAD$', re.MULTILINE)
+
+# Content with a NUL byte this close to its start is treated as binary
+BINARY_CHECK_SIZE = 8000
+
+
 def compare_trees(*trees):
-    """Compare trees and yield changed paths."""
-    entries = defaultdict(lambda: [None] * len(trees))
-    for i, tree in enumerate(trees):
-        for path, oid in tree.items():
-            entries[path][i] = oid
-    
-    for path, oids in entries.items():
-        yield(path, *oids)
+    """Compare trees and yield changed paths.
+
+    Each tree is a tree oid, a flat {path: oid} dict or None. The trees are
+    walked side by side, yielding (path, *oids) for every path whose blobs
+    differ. Subtrees with the same oid on every side are skipped without
+    being read, so the cost follows the size of the change.
+    """
+    yield from _compare_nodes([_as_node(tree) for tree in trees], '')
+
+
+def _as_node(tree):
+    """Nest a flat {path: oid} dict like a tree, leaving tree oids as they are.
+
+    Paths with a trailing slash, as sparse checkouts keep the directories
+    they leave out, map to tree oids.
+    """
+    if not isinstance(tree, dict):
+        return tree
+
+    root = {}
+    for path, oid in tree.items():
+        *dirnames, filename = path.rstrip('/').split('/')
+        current = root
+        for dirname in dirnames:
+            current = current.setdefault(dirname, ('tree', {}))[1]
+        current[filename] = ('tree' if path.endswith('/') else 'blob'), oid
+    return root
+
+
+def _compare_nodes(nodes, base_path):
+    """Yield the changed paths below a set of tree oids or nested dicts."""
+    if all(isinstance(node, str) for node in nodes) and len(set(nodes)) == 1:
+        return
+
+    sides = [_node_entries(node) for node in nodes]
+    for name in sorted(set().union(*sides)):
+        entries = [side.get(name, (None, None)) for side in sides]
+        path = base_path + name
+
+        subtrees = [node if type_ == 'tree' else None for type_, node in entries]
+        if any(subtree is not None for subtree in subtrees):
+            yield from _compare_nodes(subtrees, f'{path}/')
+
+        blobs = [oid if type_ == 'blob' else None for type_, oid in entries]
+        if len(set(blobs)) > 1:
+            yield (path, *blobs)
+
+
+def _node_entries(node):
+    """Return the {name: (type_, oid or nested dict)} entries of a tree node."""
+    if node is None:
+        return {}
+    if isinstance(node, dict):
+        return node
+    return {name: (type_, oid) for type_, oid, name in data.iter_tree_entries(node)}
 
 
 def iter_changed_files(tree1, tree2):
     """Iterate over changed files between two trees."""
     for path, o_from, o_to in compare_trees(tree1, tree2):
-        if o_from != o_to:
-            action = ('new file' if not o_from else
-                      'deleted' if not o_to else
-                      'modified')
-            yield path, action
+        action = ('new file' if not o_from else
+                  'deleted' if not o_to else
+                  'modified')
+        yield path, action
+
+
+def diff_trees(tree1, tree2, working_tree=False):
+    """Diff two trees and return the output.
 
+    With working_tree, tree2 describes the working directory and its blobs are
+    read from the files themselves, as they are not stored as objects, except
+    below the directories a sparse checkout leaves out.
+    """
+    changes = [(path, o_from, o_to, working_tree and not _is_left_out(path, tree2))
+               for path, o_from, o_to in compare_trees(tree1, tree2)]
+    # Working files are read as they are, the rest may have to be fetched
+    data.prefetch_objects(oid for _, o_from, o_to, from_file in changes for oid in (o_from, None if from_file else o_to))
 
-def diff_trees(tree1, tree2):
-    """Diff two trees and return the output."""
     output = b''
-    for path, o_from, o_to in compare_trees(tree1, tree2):
-        if o_from != o_to:
-            output += diff_blobs(o_from, o_to, path)
+    for path, o_from, o_to, from_file in changes:
+        output += diff_blobs(o_from, o_to, path, from_file)
     
     return output
 
 
-def diff_blobs(o_from, o_to, path='blob'):
-    """Diff two blobs and return the output."""
+def _is_left_out(path, tree):
+    """Tell whether a path is below a directory a sparse checkout left out of a flat tree."""
+    dirname = path
+    while '/' in dirname:
+        dirname = dirname.rpartition('/')[0]
+        if f'{dirname}/' in tree:
+            return True
+    return False
+
+
+def diff_blobs(o_from, o_to, path='blob', working_tree=False):
+    """Diff two blobs and return the output.
+
+    Blobs are diffed in-process unless 'diff.engine' is set to 'external',
+    which runs the system diff on temp files instead.
+    """
+    if data.get_config('diff.engine', 'native') == 'external':
+        return _diff_blobs_external(o_from, o_to, path, working_tree)
+
+    from_content = data.get_object(o_from) if o_from else b''
+    if working_tree and o_to:
+        with open(path, 'rb') as f:
+            to_content = f.read()
+    else:
+        to_content = data.get_object(o_to) if o_to else b''
+    return unified_diff(from_content, to_content, f'a/{path}', f'b/{path}')
+
+
+def _diff_blobs_external(o_from, o_to, path, working_tree):
+    """Diff two blobs with the system diff and return the output."""
     with Temp() as from_file, Temp() as to_file:
         for oid, file in [(o_from, from_file), (o_to, to_file)]:
-            if oid:
-                file.write(data.get_object(oid))
+            if oid and not (working_tree and file is to_file):
+                for chunk in data.iter_object(oid):
+                    file.write(chunk)
                 file.flush()
-        
+
+        to_name = path if working_tree and o_to else to_file.name
         with subprocess.Popen(
-            ['diff', '--unified', '--show-c-function', '--label', f'a/{path}',  from_file.name, '--label', f'b/{path}', to_file.name],
+            ['diff', '--unified', '--show-c-function', '--label', f'a/{path}',  from_file.name, '--label', f'b/{path}', to_name],
             stdout=subprocess.PIPE) as proc:
             output, _ = proc.communicate()
 
         return output
 
 
-def merge_trees(t_base, t_HEAD, t_other):
+def is_binary(content):
+    """Guess whether content is binary, by looking for a NUL byte near its start."""
+    return b'\x00' in content[:BINARY_CHECK_SIZE]
+
+
+def unified_diff(a, b, from_label, to_label):
+    """Diff two byte strings, producing the same output as `diff -u -p`."""
+    if a == b:
+        return b''
+    if is_binary(a) or is_binary(b):
+        return f'Binary files {from_label} and {to_label} differ\n'.encode()
+
+    a_lines = a.splitlines(keepends=True)
+    b_lines = b.splitlines(keepends=True)
+    output = [f'--- {from_label}\n+++ {to_label}\n'.encode()]
+    find_function = _function_finder(a_lines)
+    for hunk in _group_hunks(diff_lines(a_lines, b_lines)):
+        first_a, last_a, first_b, last_b = hunk[0][0], hunk[-1][1], hunk[0][2], hunk[-1][3]
+        first_a, first_b = max(first_a - CONTEXT_LINES, 0), max(first_b - CONTEXT_LINES, 0)
+        last_a = min(last_a + CONTEXT_LINES, len(a_lines))
+        last_b = min(last_b + CONTEXT_LINES, len(b_lines))
+
+        header = f'@@ -{_format_range(first_a, last_a)} +{_format_range(first_b, last_b)} @@'.encode()
+        function = find_function(first_a)
+        if function is not None:
+            header += b' ' + function
+        output.append(header + b'\n')
+
+        i = first_a
+        for i1, i2, j1, j2 in hunk:
+            output.extend(_prefix_lines(b' ', a_lines[i:i1]))
+            output.extend(_prefix_lines(b'-', a_lines[i1:i2]))
+            output.extend(_prefix_lines(b'+', b_lines[j1:j2]))
+            i = i2
+        output.extend(_prefix_lines(b' ', a_lines[i:last_a]))
+
+    return b''.join(output)
+
+
+def _prefix_lines(prefix, lines):
+    """Prefix diff lines, marking a last line that lacks its newline."""
+    for line in lines:
+        yield prefix + line
+        if not line.endswith(b'\n'):
+            yield b'\n\\ No newline at end of file\n'
+
+
+def _format_range(first, last):
+    """Format the 0-based half-open line range first:last for a hunk header."""
+    if last - first == 1:
+        return f'{first + 1}'
+    if last == first:
+        # Empty ranges name the line before them
+        return f'{first},0'
+    return f'{first + 1},{last - first}'
+
+
+def _function_finder(lines):
+    """Return a function finding the function line for a hunk starting at a line.
+
+    Like diff, each search only goes back as far as the previous one and
+    otherwise reuses its result.
+    """
+    last_search = 0
+    last_match = None
+
+    def find_function(start):
+        nonlocal last_search, last_match
+        for i in range(start - 1, last_search - 1, -1):
+            if FUNCTION_RE.match(lines[i]):
+                last_match = i
+                break
+        last_search = start
+        if last_match is None:
+            return None
+        return lines[last_match].strip()[:FUNCTION_LINE_LENGTH].rstrip()
+
+    return find_function
+
+
+def _group_hunks(changes):
+    """Group changes into hunks, joining those whose contexts would touch."""
+    hunk = []
+    for change in changes:
+        if hunk and change[0] - hunk[-1][1] > 2 * CONTEXT_LINES:
+            yield hunk
+            hunk = []
+        hunk.append(change)
+    if hunk:
+        yield hunk
+
+
+def diff_lines(a, b):
+    """Compare two sequences of lines as GNU diff does.
+
+    Returns the changed regions as (i1, i2, j1, j2) tuples, meaning that
+    a[i1:i2] was replaced by b[j1:j2]. Common leading and trailing lines are
+    matched up front, but for CONTEXT_LINES of them, which changes can still
+    slide into. Lines that only occur on one side within that range are
+    set aside before searching, since they can never be part of a match.
+    The changes found are then slid like GNU diff does, see
+    _shift_changes().
+    """
+    prefix = 0
+    while prefix < len(a) and prefix < len(b) and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < len(a) - prefix and suffix < len(b) - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+    first = max(prefix - CONTEXT_LINES, 0)
+    suffix = max(suffix - CONTEXT_LINES, 0)
+    a, b = a[first:len(a) - suffix], b[first:len(b) - suffix]
+
+    ids = {}
+    a_ids = [ids.setdefault(line, len(ids)) for line in a]
+    in_a = set(a_ids)
+    b_ids = [ids.setdefault(line, len(ids)) for line in b]
+    in_b = set(b_ids)
+    a_kept = [i for i, line_id in enumerate(a_ids) if line_id in in_b]
+    b_kept = [j for j, line_id in enumerate(b_ids) if line_id in in_a]
+
+    # Which lines are changed on each side, with a False sentinel at the end
+    # that changed[-1] also reads
+    a_changed = [True] * len(a) + [False]
+    b_changed = [True] * len(b) + [False]
+    for x, y in _myers([a_ids[i] for i in a_kept], [b_ids[j] for j in b_kept]):
+        a_changed[a_kept[x]] = b_changed[b_kept[y]] = False
+    _shift_changes(a, a_changed, b_changed)
+    _shift_changes(b, b_changed, a_changed)
+
+    changes = []
+    i = j = 0
+    while i < len(a) or j < len(b):
+        if a_changed[i] or b_changed[j]:
+            i1, j1 = i, j
+            while a_changed[i]:
+                i += 1
+            while b_changed[j]:
+                j += 1
+            changes.append((first + i1, first + i, first + j1, first + j))
+        i, j = i + 1, j + 1
+    return changes
+
+
+def _shift_changes(lines, changed, other_changed):
+    """Slide each run of changed lines to where GNU diff puts it.
+
+    A run can slide over a line equal to the one at its other end without
+    changing the script. As diff's shift_boundaries() does, runs are first
+    slid back to merge with earlier runs, then forward as far as they go,
+    and finally back to line up with a run changed on the other side, if
+    they passed one.
+    """
+    end = len(lines)
+    i = j = 0
+    while True:
+        # Find the start of the next run, following along in the other side
+        while i < end and not changed[i]:
+            while other_changed[j]:
+                j += 1
+            i, j = i + 1, j + 1
+        if i == end:
+            return
+        start = i
+        i += 1
+        while changed[i]:
+            i += 1
+        while other_changed[j]:
+            j += 1
+
+        while True:
+            length = i - start
+            while start and lines[start - 1] == lines[i - 1]:
+                start, i = start - 1, i - 1
+                changed[start], changed[i] = True, False
+                while changed[start - 1]:
+                    start -= 1
+                j -= 1
+                while other_changed[j]:
+                    j -= 1
+
+            # Where the run last lined up with one on the other side, if anywhere
+            corresponding = i if other_changed[j - 1] else end
+            while i != end and lines[start] == lines[i]:
+                changed[start], changed[i] = False, True
+                start, i = start + 1, i + 1
+                while changed[i]:
+                    i += 1
+                j += 1
+                while other_changed[j]:
+                    j += 1
+                    corresponding = i
+            if length == i - start:
+                break
+
+        while corresponding < i:
+            start, i = start - 1, i - 1
+            changed[start], changed[i] = True, False
+            j -= 1
+            while other_changed[j]:
+                j -= 1
+
+
+def _myers(a, b):
+    """Return the matched (x, y) index pairs of a short edit script from a to b.
+
+    This is the linear-space form of Myers' algorithm, as in GNU diff's
+    compareseq(): each range is split at a point the shortest script goes
+    through, found by searching from both ends at once, and the two halves
+    are diffed in turn. Common leading and trailing items of a range are
+    matched before searching it.
+    """
+    # Like GNU diff, give up on the shortest script past about the square
+    # root of the lines to compare, but never below MAX_EDIT_COST
+    max_cost = max(MAX_EDIT_COST, 1 << ((len(a) + len(b) + 3).bit_length() + 1) // 2)
+    # Furthest x reached on each diagonal k = x - y by the searches forwards
+    # and backwards, shared by all ranges. Diagonals run from -len(b) - 1 to
+    # len(a) + 1, negative ones indexing from the end.
+    forward = [0] * (len(a) + len(b) + 3)
+    backward = [0] * (len(a) + len(b) + 3)
+    matches = []
+    ranges = [(0, len(a), 0, len(b), False)]
+    while ranges:
+        x0, x1, y0, y1, minimal = ranges.pop()
+        while x0 < x1 and y0 < y1 and a[x0] == b[y0]:
+            matches.append((x0, y0))
+            x0, y0 = x0 + 1, y0 + 1
+        while x0 < x1 and y0 < y1 and a[x1 - 1] == b[y1 - 1]:
+            x1, y1 = x1 - 1, y1 - 1
+            matches.append((x1, y1))
+        if x0 == x1 or y0 == y1:
+            continue
+
+        x, y, low_minimal, high_minimal = _split(
+            a, x0, x1, b, y0, y1, forward, backward, None if minimal else max_cost)
+        ranges.append((x0, x, y0, y, low_minimal))
+        ranges.append((x, x1, y, y1, high_minimal))
+
+    matches.sort()
+    return matches
+
+
+def _split(a, x0, x1, b, y0, y1, forward, backward, max_cost):
+    """Find where to split a[x0:x1] against b[y0:y1], as GNU diff's diag() does.
+
+    The ranges must differ at both ends. Returns the point (x, y) and
+    whether the script found for each half of it is still the shortest.
+    Past max_cost edits from either end, unless it is None, the search
+    gives up and splits at the point furthest along from either end.
+    """
+    # Search forwards from (x0, y0) and backwards from (x1, y1), recording
+    # the furthest x reached on each diagonal in forward and backward
+    k_min, k_max = x0 - y1, x1 - y0
+    forward_k, backward_k = x0 - y0, x1 - y1
+    forward[forward_k], backward[backward_k] = x0, x1
+    f_min = f_max = forward_k
+    b_min = b_max = backward_k
+    odd = (forward_k - backward_k) % 2
+    cost = 0
+    while True:
+        cost += 1
+
+        # Each diagonal one edit further starts from the furthest of its
+        # neighbours, taking a deletion over an insertion on a tie. The
+        # diagonals just outside the searched ones hold values that never win.
+        if f_min > k_min:
+            f_min -= 1
+            forward[f_min - 1] = -1
+        else:
+            f_min += 1
+        if f_max < k_max:
+            f_max += 1
+            forward[f_max + 1] = -1
+        else:
+            f_max -= 1
+        for k in range(f_max, f_min - 1, -2):
+            low, high = forward[k - 1], forward[k + 1]
+            x = low + 1 if low >= high else high
+            y = x - k
+            while x < x1 and y < y1 and a[x] == b[y]:
+                x, y = x + 1, y + 1
+            forward[k] = x
+            if odd and b_min <= k <= b_max and backward[k] <= x:
+                return x, y, True, True
+
+        if b_min > k_min:
+            b_min -= 1
+            backward[b_min - 1] = x1 + 1
+        else:
+            b_min += 1
+        if b_max < k_max:
+            b_max += 1
+            backward[b_max + 1] = x1 + 1
+        else:
+            b_max -= 1
+        for k in range(b_max, b_min - 1, -2):
+            low, high = backward[k - 1], backward[k + 1]
+            x = low if low < high else high - 1
+            y = x - k
+            while x > x0 and y > y0 and a[x - 1] == b[y - 1]:
+                x, y = x - 1, y - 1
+            backward[k] = x
+            if not odd and f_min <= k <= f_max and x <= forward[k]:
+                return x, y, True, True
+
+        if max_cost is None or cost < max_cost:
+            continue
+        # Too costly: settle for the point either search got furthest
+        # along to, as measured by x + y
+        forward_xy = -1
+        for k in range(f_max, f_min - 1, -2):
+            x = min(forward[k], x1, y1 + k)
+            if x + x - k > forward_xy:
+                forward_x, forward_xy = x, x + x - k
+        backward_xy = x1 + y1 + 1
+        for k in range(b_max, b_min - 1, -2):
+            x = max(backward[k], x0, y0 + k)
+            if x + x - k < backward_xy:
+                backward_x, backward_xy = x, x + x - k
+        if x1 + y1 - backward_xy < forward_xy - x0 - y0:
+            return forward_x, forward_xy - forward_x, True, False
+        return backward_x, backward_xy - backward_x, False, True
+
+
+def merge_trees(t_base, t_HEAD, t_other, conflicts=None):
+    """Merge three trees, returning {path: oid} for the paths where they differ.
+
+    Paths are resolved by oid where possible, so only paths changed on both
+    sides have their content merged. Deleted paths map to None. If
+    conflicts is given, the paths left with conflict markers are added to it.
+    """
     tree = {}
+    both_changed = []
     for path, o_base, o_HEAD, o_other in compare_trees(t_base, t_HEAD, t_other):
-        tree[path] = data.hash_object(merge_blobs(o_base, o_HEAD, o_other))
+        if o_HEAD == o_other or o_other == o_base:
+            tree[path] = o_HEAD
+        elif o_HEAD == o_base:
+            tree[path] = o_other
+        else:
+            both_changed.append((path, o_base, o_HEAD, o_other))
+
+    data.prefetch_objects(oid for _, *oids in both_changed for oid in oids)
+    for path, o_base, o_HEAD, o_other in both_changed:
+        merged = merge_blobs(o_base, o_HEAD, o_other)
+        if conflicts is not None and CONFLICT_RE.search(merged):
+            conflicts.add(path)
+        tree[path] = data.hash_object(merged)
     return tree
 
 
 def merge_blobs(o_base, o_HEAD, o_other):
+    """Merge the changes from base to HEAD and to other, marking conflicts.
+
+    Blobs are merged in-process unless 'merge.engine' is set to 'external',
+    which runs the system diff3 on temp files instead.
+    """
+    if data.get_config('merge.engine', 'native') == 'external':
+        return _merge_blobs_external(o_base, o_HEAD, o_other)
+
+    base, HEAD, other = (data.get_object(oid) if oid else b'' for oid in (o_base, o_HEAD, o_other))
+    if is_binary(base) or is_binary(HEAD) or is_binary(other):
+        # Binary content can't be merged by lines, keep our side
+        return HEAD
+    return merge3(base, HEAD, other)
+
+
+def merge3(base, ours, theirs, labels=('HEAD', 'BASE', 'MERGE_HEAD')):
+    """Merge two byte strings derived from base, like `diff3 -m`.
+
+    Changes made by one side, or identically by both, are taken as they are.
+    Overlapping changes are written as a conflict showing our, base and
+    their versions between markers named by labels.
+    """
+    base_lines = base.splitlines(keepends=True)
+    ours_lines = ours.splitlines(keepends=True)
+    theirs_lines = theirs.splitlines(keepends=True)
+
+    changes = sorted(
+        [(change, 0) for change in diff_lines(base_lines, ours_lines)] +
+        [(change, 1) for change in diff_lines(base_lines, theirs_lines)])
+
+    output = []
+    i = 0
+    while changes:
+        # Group changes from both sides that overlap or touch in base
+        group = [changes.pop(0)]
+        lo, hi = group[0][0][0], group[0][0][1]
+        while changes and changes[0][0][0] <= hi:
+            group.append(changes.pop(0))
+            hi = max(hi, group[-1][0][1])
+
+        output.extend(base_lines[i:lo])
+        i = hi
+
+        sides = []
+        for side, lines in enumerate((ours_lines, theirs_lines)):
+            side_changes = [change for change, change_side in group if change_side == side]
+            if not side_changes:
+                sides.append(base_lines[lo:hi])
+                continue
+            first, last = side_changes[0], side_changes[-1]
+            sides.append(lines[first[2] - (first[0] - lo):last[3] + (hi - last[1])])
+
+        ours_chunk, theirs_chunk = sides
+        if ours_chunk == theirs_chunk or theirs_chunk == base_lines[lo:hi]:
+            output.extend(ours_chunk)
+        elif ours_chunk == base_lines[lo:hi]:
+            output.extend(theirs_chunk)
+        else:
+            ours_label, base_label, theirs_label = labels
+            output.append(f'<<<<<<< {ours_label}\n'.encode())
+            output.extend(_terminate_lines(ours_chunk))
+            output.append(f'||||||| {base_label}\n'.encode())
+            output.extend(_terminate_lines(base_lines[lo:hi]))
+            output.append(b'=======\n')
+            output.extend(_terminate_lines(theirs_chunk))
+            output.append(f'>>>>>>> {theirs_label}\n'.encode())
+
+    output.extend(base_lines[i:])
+    return b''.join(output)
+
+
+def _terminate_lines(lines):
+    """Make sure the last line ends with a newline, so a marker can follow it."""
+    if lines and not lines[-1].endswith(b'\n'):
+        return lines[:-1] + [lines[-1] + b'\n']
+    return lines
+
+
+def _merge_blobs_external(o_base, o_HEAD, o_other):
+    """Merge three blobs with the system diff3 and return the output."""
     with Temp() as f_base, Temp() as f_HEAD, Temp() as f_other:
 
         #Write blobs to temporary files
         for oid, f in ((o_base, f_base), (o_HEAD, f_HEAD), (o_other, f_other)):
             if oid:
-                f.write(data.get_object(oid))
+                for chunk in data.iter_object(oid):
+                    f.write(chunk)
                 f.flush()
         
         with subprocess.Popen(
@@ -0,0 +1,257 @@
+"""The binary index: staged paths with their oids and cached stat data.
+
+The file holds a header, a table of entry offsets sorted by path, then one
+entry per path: fixed-width oid and stat fields followed by the UTF-8 path.
+An optional cache-tree extension follows, holding the tree oids of the
+directories that haven't changed since their trees were last written, and
+finally a SHA-1 checksum of everything before it. The file is mmap'd and
+looked up by binary search over the offset table, so reading a few entries
+doesn't decode the rest. Changes are kept aside until the index is
+written back as a whole, which only happens when there are any.
+"""
+
+import bisect
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import struct
+from collections import namedtuple
+from collections.abc import MutableMapping
+from operator import itemgetter
+
+
+SIGNATURE = b'AIDX'
+VERSION = 1
+
+IndexEntry = namedtuple('IndexEntry', ['oid', 'mtime_ns', 'ctime_ns', 'size', 'ino', 'mode'])
+
+_HEADER = struct.Struct('>4sII')
+_OFFSET = struct.Struct('>I')
+_ENTRY = struct.Struct('>20sQQQQIH')
+
+TREE_SIGNATURE = b'TREE'
+_TREE_HEADER = struct.Struct('>4sI')
+_TREE_RECORD = struct.Struct('>20sH')
+
+
+class Index(MutableMapping):
+    """A path -> IndexEntry mapping read lazily from an index file.
+
+    Entries are changed in memory only; dirty tells whether they differ
+    from the file, and write replaces it. Alongside the entries, the index
+    caches the tree oid of directories ('' for the root), which changing
+    an entry forgets for all of the entry's parent directories.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+        self._count = 0
+        # path -> new entry, or None for paths removed from the file
+        self._changes = {}
+        self._added = None
+        self._cleared = False
+        self._trees = {}
+        self._trees_changed = False
+
+        try:
+            with open(path, 'rb') as f:
+                if f.read(len(SIGNATURE)) != SIGNATURE:
+                    # Older indexes were JSON, with bare oids before stat data
+                    f.seek(0)
+                    for name, value in json.load(f).items():
+                        oid, *stat = [value] if isinstance(value, str) else value
+                        self._changes[name] = IndexEntry(oid, *(stat or [0] * 5))
+                else:
+                    self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            pass
+
+        if self._map is not None:
+            signature, version, self._count = _HEADER.unpack_from(self._map)
+            if version != VERSION:
+                raise ValueError(f'Unsupported index version {version}')
+            if hashlib.sha1(self._map[:-20]).digest() != self._map[-20:]:
+                raise ValueError(f'Corrupt index {path}')
+            self._read_trees()
+        self._size = self._count + len(self._changes)
+
+    def _read_trees(self):
+        """Load the cache-tree extension, if the file has one."""
+        if self._count:
+            at = _OFFSET.unpack_from(self._map, _HEADER.size + _OFFSET.size * (self._count - 1))[0]
+            at += _ENTRY.size + _ENTRY.unpack_from(self._map, at)[-1]
+        else:
+            at = _HEADER.size
+        if self._map[at:at + len(TREE_SIGNATURE)] != TREE_SIGNATURE:
+            return
+
+        _, count = _TREE_HEADER.unpack_from(self._map, at)
+        at += _TREE_HEADER.size
+        for _ in range(count):
+            oid, path_len = _TREE_RECORD.unpack_from(self._map, at)
+            at += _TREE_RECORD.size
+            self._trees[self._map[at:at + path_len].decode()] = oid.hex()
+            at += path_len
+
+    @property
+    def dirty(self):
+        return bool(self._changes) or self._cleared or self._trees_changed
+
+    def get_tree_oid(self, dirname):
+        """Return the cached tree oid of a directory, or None if it changed since."""
+        return self._trees.get(dirname)
+
+    def set_tree_oid(self, dirname, oid):
+        """Cache the tree oid of a directory, as written from the current entries."""
+        if self._trees.get(dirname) != oid:
+            self._trees[dirname] = oid
+            self._trees_changed = True
+
+    def iter_tree_oids(self):
+        """Yield the (dirname, oid) pairs of the cached trees."""
+        yield from self._trees.items()
+
+    def _invalidate_trees(self, path):
+        """Forget the tree oids of all directories above a path."""
+        dirname = path
+        while dirname:
+            dirname = dirname.rpartition('/')[0]
+            if self._trees.pop(dirname, None):
+                self._trees_changed = True
+
+    def _entry_at(self, pos):
+        """Return the path and entry at a position of the offset table."""
+        at = _OFFSET.unpack_from(self._map, _HEADER.size + _OFFSET.size * pos)[0]
+        oid, *stat, path_len = _ENTRY.unpack_from(self._map, at)
+        at += _ENTRY.size
+        return self._map[at:at + path_len].decode(), IndexEntry(oid.hex(), *stat)
+
+    def _bisect(self, path):
+        """Return the position of the first path in the file not before path."""
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry_at(mid)[0] < path:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _find(self, path):
+        """Return the file's entry for a path, ignoring changes, or None."""
+        pos = self._bisect(path)
+        if pos < self._count:
+            current, entry = self._entry_at(pos)
+            if current == path:
+                return entry
+        return None
+
+    def next_item(self, start):
+        """Return the first (path, entry) whose path is not before start, or None."""
+        pos = self._bisect(start)
+        item = None
+        while pos < self._count:
+            item = self._entry_at(pos)
+            if item[0] not in self._changes:
+                break
+            item = None
+            pos += 1
+
+        if self._added is None:
+            self._added = sorted(path for path, entry in self._changes.items() if entry is not None)
+        i = bisect.bisect_left(self._added, start)
+        if i < len(self._added) and (item is None or self._added[i] < item[0]):
+            return self._added[i], self._changes[self._added[i]]
+        return item
+
+    def _iter_file(self):
+        for pos in range(self._count):
+            yield self._entry_at(pos)
+
+    def __getitem__(self, path):
+        entry = self._changes[path] if path in self._changes else self._find(path)
+        if entry is None:
+            raise KeyError(path)
+        return entry
+
+    def __setitem__(self, path, entry):
+        current = self.get(path)
+        if current is None:
+            self._size += 1
+        if current is None or current.oid != entry.oid:
+            self._invalidate_trees(path)
+        if entry == self._find(path):
+            self._changes.pop(path, None)
+        else:
+            self._changes[path] = entry
+        self._added = None
+
+    def __delitem__(self, path):
+        if path not in self:
+            raise KeyError(path)
+        self._size -= 1
+        self._invalidate_trees(path)
+        if self._find(path) is None:
+            del self._changes[path]
+        else:
+            self._changes[path] = None
+        self._added = None
+
+    def __iter__(self):
+        for path, _ in self.items():
+            yield path
+
+    def __len__(self):
+        return self._size
+
+    def items(self):
+        """Yield (path, entry) pairs sorted by path, reading the file sequentially."""
+        added = sorted((path, entry) for path, entry in self._changes.items() if entry is not None)
+        previous = None
+        for path, entry in heapq.merge(self._iter_file(), added, key=itemgetter(0)):
+            if path == previous:
+                continue
+            previous = path
+            if path in self._changes:
+                entry = self._changes[path]
+                if entry is None:
+                    continue
+            yield path, entry
+
+    def clear(self):
+        self._cleared = self._cleared or bool(self._count or self._changes)
+        self._map = None
+        self._count = 0
+        self._changes = {}
+        self._added = None
+        self._size = 0
+        self._trees_changed = self._trees_changed or bool(self._trees)
+        self._trees = {}
+
+    def write(self, lock_path):
+        """Write the entries into the index's held lock file and move it into place."""
+        offsets, entries = [], []
+        at = _HEADER.size + _OFFSET.size * len(self)
+        for path, entry in self.items():
+            name = path.encode()
+            offsets.append(_OFFSET.pack(at))
+            entries.append(_ENTRY.pack(bytes.fromhex(entry.oid), *entry[1:], len(name)) + name)
+            at += len(entries[-1])
+        trees = []
+        for dirname, oid in sorted(self._trees.items()):
+            name = dirname.encode()
+            trees.append(_TREE_RECORD.pack(bytes.fromhex(oid), len(name)) + name)
+        content = b''.join([
+            _HEADER.pack(SIGNATURE, VERSION, len(entries)), *offsets, *entries,
+            _TREE_HEADER.pack(TREE_SIGNATURE, len(trees)), *trees,
+        ])
+
+        with open(lock_path, 'wb') as f:
+            f.write(content)
+            f.write(hashlib.sha1(content).digest())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(lock_path, self.path)
@@ -0,0 +1,554 @@
+"""Pack files: many objects stored in one file, found through a sorted index.
+
+A pack holds a short header followed by one entry per object: a type byte
+and the object's zlib-deflated content. Delta entries instead hold the
+distance back to their base entry and a deflated delta against it. The
+.idx companion holds a 256-entry fan-out table of cumulative counts by
+first oid byte, the sorted binary oids, their offsets in the pack, and the
+pack and index checksums. Both files are mmap'd, so a lookup is a binary
+search over mapped pages.
+"""
+
+import hashlib
+import itertools
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict, deque
+
+from . import data
+
+
+PACK_SIGNATURE = b'APCK'
+INDEX_SIGNATURE = b'APKI'
+VERSION = 1
+
+TYPE_CODES = {'commit': 1, 'tree': 2, 'blob': 3}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+OFS_DELTA = 6
+
+# Packed objects are deflated and inflated in pieces of this size
+CHUNK_SIZE = 1 << 20
+
+# Objects larger than this are always stored whole rather than as deltas
+DELTA_SIZE_LIMIT = 16 << 20
+
+# Memory budget for resolved delta bases kept by each open pack
+DELTA_BASE_CACHE_SIZE = 16 << 20
+
+# Deltas match content in blocks of this many bytes
+_BLOCK = 16
+
+_HEADER = struct.Struct('>4sI')
+_FANOUT = struct.Struct('>256I')
+_OFFSET = struct.Struct('>Q')
+
+
+class PackIndex:
+    """A memory-mapped pack index supporting binary search by oid."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version = _HEADER.unpack_from(self._map)
+        if signature != INDEX_SIGNATURE or version != VERSION:
+            raise ValueError(f'Unsupported pack index {path}')
+
+        self._fanout = _FANOUT.unpack_from(self._map, _HEADER.size)
+        self._oids_at = _HEADER.size + _FANOUT.size
+        self._offsets_at = self._oids_at + 20 * len(self)
+
+    def __len__(self):
+        return self._fanout[-1]
+
+    def oid_at(self, pos):
+        """Return the oid at a position in sorted order."""
+        at = self._oids_at + 20 * pos
+        return self._map[at:at + 20].hex()
+
+    def offset_at(self, pos):
+        """Return the pack offset of the object at a position in sorted order."""
+        return _OFFSET.unpack_from(self._map, self._offsets_at + _OFFSET.size * pos)[0]
+
+    def find_position(self, oid):
+        """Return the sorted position of an oid, or None if it is not in the pack."""
+        return bisect_oid(self._map, self._oids_at, self._fanout, oid)
+
+    def find(self, oid):
+        """Return the pack offset of an oid, or None if it is not in the pack."""
+        pos = self.find_position(oid)
+        return None if pos is None else self.offset_at(pos)
+
+    def iter_oids(self):
+        """Yield all oids in the pack in sorted order."""
+        for pos in range(len(self)):
+            yield self.oid_at(pos)
+
+
+class Pack:
+    """A pack file and its index, both mapped into memory."""
+
+    def __init__(self, path):
+        self.path = path
+        self.index = PackIndex(f'{path}.idx')
+        with open(f'{path}.pack', 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version = _HEADER.unpack_from(self._map)
+        if signature != PACK_SIGNATURE or version != VERSION:
+            raise ValueError(f'Unsupported pack {path}')
+        self._bases = OrderedDict()
+        self._bases_size = 0
+        self._bases_lock = threading.Lock()
+
+    def __contains__(self, oid):
+        return self.index.find_position(oid) is not None
+
+    def iter_object(self, offset):
+        """Yield the raw bytes of the entry at an offset: the type header, then its content."""
+        code = self._map[offset]
+        if code == OFS_DELTA:
+            type_, content = self._resolve(offset)
+            yield f'{type_}\x00'.encode()
+            yield content
+        else:
+            yield f'{TYPE_NAMES[code]}\x00'.encode()
+            yield from _inflate(self._map, offset + 1)
+
+    def _resolve(self, offset):
+        """Return the type and full content of the entry at an offset, applying deltas."""
+        code = self._map[offset]
+        if code != OFS_DELTA:
+            return TYPE_NAMES[code], b''.join(_inflate(self._map, offset + 1))
+
+        distance, pos = _decode_varint(self._map, offset + 1)
+        type_, base = self._get_base(offset - distance)
+        return type_, apply_delta(base, b''.join(_inflate(self._map, pos)))
+
+    def _get_base(self, offset):
+        """Resolve a delta base, keeping recently used bases in a bounded cache.
+
+        The cache may be shared by threads; bases are resolved outside its
+        lock, as that recurses into further bases.
+        """
+        with self._bases_lock:
+            if offset in self._bases:
+                self._bases.move_to_end(offset)
+                return self._bases[offset]
+
+        type_, content = self._resolve(offset)
+        with self._bases_lock:
+            if offset not in self._bases:
+                self._bases[offset] = type_, content
+                self._bases_size += len(content)
+            while self._bases_size > DELTA_BASE_CACHE_SIZE and len(self._bases) > 1:
+                _, (_, evicted) = self._bases.popitem(last=False)
+                self._bases_size -= len(evicted)
+        return type_, content
+
+
+def bisect_oid(buf, oids_at, fanout, oid):
+    """Binary search a table of sorted binary oids for oid, guided by its fan-out.
+
+    Returns the oid's position in the table, or None if it is not there.
+    """
+    try:
+        key = bytes.fromhex(oid)
+    except ValueError:
+        return None
+    if len(key) != 20:
+        return None
+
+    lo = fanout[key[0] - 1] if key[0] else 0
+    hi = fanout[key[0]]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        at = oids_at + 20 * mid
+        current = buf[at:at + 20]
+        if current == key:
+            return mid
+        if current < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return None
+
+
+def build_fanout(oids):
+    """Build a fan-out table of cumulative counts by first byte for sorted hex oids."""
+    fanout = [0] * 256
+    for oid in oids:
+        fanout[int(oid[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+    return fanout
+
+
+def _inflate(buf, pos):
+    """Yield the content of the zlib stream starting at pos in buf."""
+    inflater = zlib.decompressobj()
+    while not inflater.eof:
+        chunk = buf[pos:pos + CHUNK_SIZE]
+        if not chunk:
+            raise ValueError('Truncated pack entry')
+        pos += len(chunk)
+        yield inflater.decompress(chunk, CHUNK_SIZE)
+        while inflater.unconsumed_tail and not inflater.eof:
+            yield inflater.decompress(inflater.unconsumed_tail, CHUNK_SIZE)
+
+
+def _encode_varint(n):
+    """Encode a non-negative integer in little-endian groups of 7 bits."""
+    out = bytearray()
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _decode_varint(buf, pos):
+    """Decode a varint at pos in buf, returning the value and the position after it."""
+    n = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return n, pos
+
+
+def index_delta_base(base):
+    """Map the aligned blocks of a delta base to their offsets."""
+    return {base[k:k + _BLOCK]: k for k in range(0, len(base) - _BLOCK + 1, _BLOCK)}
+
+
+def create_delta(base, target, base_index=None, max_size=None):
+    """Encode target as copy and insert instructions against base.
+
+    Returns None when the delta would be larger than max_size.
+    """
+    if base_index is None:
+        base_index = index_delta_base(base)
+
+    out = bytearray(_encode_varint(len(base)) + _encode_varint(len(target)))
+    n, n_base = len(target), len(base)
+    literal_start = i = 0
+    while i + _BLOCK <= n:
+        k = base_index.get(target[i:i + _BLOCK])
+        if k is None:
+            i += 1
+            continue
+
+        # Extend the match forwards, a slice at a time, then backwards into
+        # the pending literal
+        j, m = i + _BLOCK, k + _BLOCK
+        while j < n and m < n_base:
+            step = min(64, n - j, n_base - m)
+            if target[j:j + step] == base[m:m + step]:
+                j, m = j + step, m + step
+                continue
+            while target[j] == base[m]:
+                j, m = j + 1, m + 1
+            break
+        while i > literal_start and k > 0 and target[i - 1] == base[k - 1]:
+            i, k = i - 1, k - 1
+
+        _emit_insert(out, target[literal_start:i])
+        _emit_copy(out, k, j - i)
+        literal_start = i = j
+        if max_size is not None and len(out) > max_size:
+            return None
+
+    _emit_insert(out, target[literal_start:])
+    if max_size is not None and len(out) > max_size:
+        return None
+    return bytes(out)
+
+
+def _emit_insert(out, literal):
+    """Append insert instructions for a literal, at most 127 bytes each."""
+    for start in range(0, len(literal), 0x7f):
+        piece = literal[start:start + 0x7f]
+        out.append(len(piece))
+        out += piece
+
+
+def _emit_copy(out, offset, size):
+    """Append copy instructions, with only the non-zero offset and size bytes."""
+    while size:
+        piece = min(size, 0xffffff)
+        cmd, args = 0x80, bytearray()
+        for i in range(4):
+            byte = (offset >> (8 * i)) & 0xff
+            if byte:
+                cmd |= 1 << i
+                args.append(byte)
+        for i in range(3):
+            byte = (piece >> (8 * i)) & 0xff
+            if byte:
+                cmd |= 0x10 << i
+                args.append(byte)
+        out.append(cmd)
+        out += args
+        offset += piece
+        size -= piece
+
+
+def apply_delta(base, delta):
+    """Rebuild a target from its delta base and the delta created by create_delta()."""
+    base_size, pos = _decode_varint(delta, 0)
+    target_size, pos = _decode_varint(delta, pos)
+    if base_size != len(base):
+        raise ValueError('Delta does not match its base')
+
+    out = bytearray()
+    while pos < len(delta):
+        cmd = delta[pos]
+        pos += 1
+        if cmd & 0x80:
+            offset = size = 0
+            for i in range(4):
+                if cmd & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if cmd & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            out += base[offset:offset + (size or 0x10000)]
+        elif cmd:
+            out += delta[pos:pos + cmd]
+            pos += cmd
+        else:
+            raise ValueError('Invalid delta instruction')
+
+    if len(out) != target_size:
+        raise ValueError('Delta produced the wrong size')
+    return bytes(out)
+
+
+def deltify(objects, window, depth):
+    """Choose delta bases for objects to be packed.
+
+    objects yields (oid, type_, chunks), ordered so that similar objects
+    are close together. Each tree or blob is compared against the `window`
+    preceding objects of its type and stored as the smallest delta that
+    saves at least half its size, keeping chains at most `depth` long.
+    Yields entries for write_pack().
+    """
+    candidates = deque(maxlen=window)
+    depths = {}
+    for oid, type_, chunks in objects:
+        chunks = iter(chunks)
+        head, size = [], 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size > DELTA_SIZE_LIMIT:
+                break
+        if size > DELTA_SIZE_LIMIT or type_ == 'commit' or not window:
+            yield oid, type_, itertools.chain(head, chunks), None
+            continue
+
+        content = b''.join(head)
+        best = None
+        for c_oid, c_type, c_content, c_index in candidates:
+            if c_type != type_ or depths[c_oid] >= depth:
+                continue
+            max_size = len(best[1]) - 1 if best else len(content) // 2
+            delta = create_delta(c_content, content, c_index, max_size)
+            if delta is not None:
+                best = c_oid, delta
+
+        depths[oid] = depths[best[0]] + 1 if best else 0
+        yield oid, type_, [content], best
+        candidates.append((oid, type_, content, index_delta_base(content)))
+
+
+def write_pack(pack_dir, objects, level=zlib.Z_DEFAULT_COMPRESSION):
+    """Write objects into a new pack and index in pack_dir.
+
+    objects yields (oid, type_, chunks, delta) tuples, where chunks iterates
+    over the object's content and delta is None or (base_oid, delta) for a
+    base written earlier in the pack. Returns the pack's path without an
+    extension.
+    """
+    def write_content(out):
+        entries = {}
+        sha = hashlib.sha1()
+
+        def write(buf):
+            sha.update(buf)
+            out.write(buf)
+            return len(buf)
+
+        offset = write(_HEADER.pack(PACK_SIGNATURE, VERSION))
+        for oid, type_, chunks, delta in objects:
+            if oid in entries:
+                continue
+            entries[oid] = offset
+            if delta:
+                base_oid, chunks = delta[0], [delta[1]]
+                offset += write(bytes([OFS_DELTA]) + _encode_varint(offset - entries[base_oid]))
+            else:
+                offset += write(bytes([TYPE_CODES[type_]]))
+            deflater = zlib.compressobj(level)
+            for chunk in chunks:
+                offset += write(deflater.compress(chunk))
+            offset += write(deflater.flush())
+
+        pack_checksum = sha.digest()
+        out.write(pack_checksum)
+        return entries, pack_checksum
+
+    return _write_pack_file(pack_dir, write_content)
+
+
+def stream_pack(objects, level=zlib.Z_DEFAULT_COMPRESSION, progress=None):
+    """Yield a pack of whole objects piece by piece, for sending elsewhere.
+
+    objects yields (oid, type_, chunks) tuples. The pieces make up a
+    regular pack file, which index_pack() can store on the other side.
+    Objects are deflated chunk by chunk and yielded as the deflater
+    produces output, so no object is ever held whole. progress is called
+    with the number of objects and bytes yielded so far.
+    """
+    sha = hashlib.sha1()
+    size = 0
+
+    def emit(piece):
+        nonlocal size
+        sha.update(piece)
+        size += len(piece)
+        return piece
+
+    yield emit(_HEADER.pack(PACK_SIGNATURE, VERSION))
+    for count, (_, type_, chunks) in enumerate(objects, 1):
+        deflater = zlib.compressobj(level)
+        yield emit(bytes([TYPE_CODES[type_]]))
+        for chunk in chunks:
+            piece = deflater.compress(chunk)
+            if piece:
+                yield emit(piece)
+        yield emit(deflater.flush())
+        if progress:
+            progress(count, size)
+    yield sha.digest()
+
+
+def index_pack(pack_dir, pieces, progress=None):
+    """Store a pack arriving as pieces of bytes in pack_dir, returning its path.
+
+    Each entry is hashed as soon as it has fully arrived, so the index is
+    ready when the last piece is, without reading the pack back. Only
+    packs of whole objects, as from stream_pack(), are accepted. progress
+    is called with the number of objects and bytes received so far.
+    """
+    def write_content(out):
+        entries = {}
+        sha = hashlib.sha1()
+        # Unparsed bytes, starting at offset in the pack; the last 20 may be the checksum
+        pending, offset = b'', 0
+        received = 0
+        # (offset, object hash, inflater) of the entry being received
+        entry = None
+
+        for piece in pieces:
+            out.write(piece)
+            received += len(piece)
+            pending += piece
+            available = len(pending) - 20
+
+            pos = 0
+            if offset == 0 and available >= _HEADER.size:
+                signature, version = _HEADER.unpack_from(pending)
+                if signature != PACK_SIGNATURE or version != VERSION:
+                    raise ValueError('Unsupported pack')
+                pos = _HEADER.size
+            elif offset == 0:
+                continue
+
+            while pos < available:
+                if entry is None:
+                    code = pending[pos]
+                    if code not in TYPE_NAMES:
+                        raise ValueError(f'Unsupported pack entry at {offset + pos}')
+                    entry = offset + pos, hashlib.sha1(f'{TYPE_NAMES[code]}\x00'.encode()), zlib.decompressobj()
+                    pos += 1
+                    continue
+
+                start, object_sha, inflater = entry
+                deflated = pending[pos:available]
+                # Inflated a chunk at a time, however much a piece holds
+                object_sha.update(inflater.decompress(deflated, CHUNK_SIZE))
+                while inflater.unconsumed_tail and not inflater.eof:
+                    object_sha.update(inflater.decompress(inflater.unconsumed_tail, CHUNK_SIZE))
+                pos += len(deflated) - len(inflater.unused_data)
+                if inflater.eof:
+                    entries[object_sha.hexdigest()] = start
+                    entry = None
+                    if progress:
+                        progress(len(entries), received)
+
+            sha.update(pending[:pos])
+            pending, offset = pending[pos:], offset + pos
+
+        pack_checksum = sha.digest()
+        if entry is not None or offset < _HEADER.size or pending != pack_checksum:
+            raise ValueError('Truncated or corrupt pack')
+        return entries, pack_checksum
+
+    return _write_pack_file(pack_dir, write_content)
+
+
+def _write_pack_file(pack_dir, write_content):
+    """Write a new pack in pack_dir through a temp file, returning its path without an extension.
+
+    write_content(out) writes the whole pack to the temp file and returns
+    its {oid: offset} entries and checksum. The pack is then indexed and
+    both files are moved into place.
+    """
+    os.makedirs(pack_dir, exist_ok=True)
+    fd, tmp_pack = tempfile.mkstemp(dir=pack_dir, prefix='tmp_pack_')
+    data.make_read_only(fd)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            entries, pack_checksum = write_content(out)
+        path = os.path.join(pack_dir, f'pack-{pack_checksum.hex()}')
+        tmp_index = _write_index(pack_dir, entries, pack_checksum)
+        # Readers discover packs through their index, so it goes in place last
+        os.replace(tmp_pack, f'{path}.pack')
+        os.replace(tmp_index, f'{path}.idx')
+    finally:
+        if os.path.exists(tmp_pack):
+            os.remove(tmp_pack)
+    return path
+
+
+def _write_index(pack_dir, entries, pack_checksum):
+    """Write the index for a pack's {oid: offset} entries to a temp file."""
+    oids = sorted(entries)
+    fanout = build_fanout(oids)
+
+    sha = hashlib.sha1()
+    fd, tmp_index = tempfile.mkstemp(dir=pack_dir, prefix='tmp_idx_')
+    data.make_read_only(fd)
+    with os.fdopen(fd, 'wb') as out:
+        def write(buf):
+            sha.update(buf)
+            out.write(buf)
+
+        write(_HEADER.pack(INDEX_SIGNATURE, VERSION))
+        write(_FANOUT.pack(*fanout))
+        write(b''.join(bytes.fromhex(oid) for oid in oids))
+        write(b''.join(_OFFSET.pack(entries[oid]) for oid in oids))
+        write(pack_checksum)
+        out.write(sha.digest())
+    return tmp_index
@@ -0,0 +1,142 @@
+"""The wire protocol between `agit serve` and the clients of a remote URL.
+
+Remotes are reached at agit://host[:port] over TCP or unix:path over a
+Unix socket. Everything sent either way is a frame: a 4-byte big-endian
+length followed by that many bytes. Requests and replies are JSON objects
+of one frame each; packs follow them as a run of frames of raw pack data
+ended by an empty frame. A reply holding an 'error' reports a failed
+request, after which the server closes the connection. Fetches may leave
+out shallow, depth, exclude and filter, see base.get_fetch_objects().
+
+    {'command': 'ls-refs', 'prefix': ...}
+        -> {'refs': {ref: oid}}
+    {'command': 'fetch', 'wants': [oid], 'haves': [oid],
+     'shallow': [oid], 'depth': n, 'exclude': [ref], 'filter': 'blob:none'}
+        -> {'count': n, 'shallow': [oid]}, then a pack of the n objects if
+           there are any
+    {'command': 'get-objects', 'oids': [oid]}
+        -> {'count': n}, then a pack of the n objects if there are any
+    {'command': 'push', 'ref': ..., 'old': oid, 'new': oid, 'count': n},
+    then a pack of the n objects if there are any
+        -> {}
+"""
+
+import json
+import socket
+import struct
+from urllib.parse import urlsplit
+
+
+DEFAULT_PORT = 9418
+
+# Pack data is regrouped into frames of this size
+FRAME_SIZE = 1 << 16
+# Largest frame accepted, which bounds the size of a request or reply
+MAX_FRAME_SIZE = 1 << 26
+
+_LENGTH = struct.Struct('>I')
+FRAME_HEADER_SIZE = _LENGTH.size
+
+
+def is_url(remote):
+    """Tell whether a remote is a URL served by `agit serve` rather than a path."""
+    return urlsplit(remote).scheme in ('agit', 'unix')
+
+
+def parse_url(url):
+    """Split a remote URL into its scheme and socket address."""
+    parts = urlsplit(url)
+    if parts.scheme == 'unix' and parts.path:
+        return 'unix', parts.path
+    if parts.scheme == 'agit':
+        return 'agit', (parts.hostname or 'localhost', parts.port or DEFAULT_PORT)
+    raise ValueError(f'Unsupported remote URL {url}')
+
+
+def encode_frame(payload):
+    return _LENGTH.pack(len(payload)) + payload
+
+
+def encode_message(message):
+    return encode_frame(json.dumps(message).encode())
+
+
+def decode_length(header):
+    """Return the payload length of a frame from its header."""
+    length = _LENGTH.unpack(header)[0]
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f'Frame of {length} bytes is too large')
+    return length
+
+
+def iter_frames(pieces):
+    """Regroup pack pieces into frame payloads of FRAME_SIZE bytes, the last one shorter."""
+    buffer = bytearray()
+    for piece in pieces:
+        buffer += piece
+        while len(buffer) >= FRAME_SIZE:
+            yield bytes(buffer[:FRAME_SIZE])
+            del buffer[:FRAME_SIZE]
+    if buffer:
+        yield bytes(buffer)
+
+
+class Connection:
+    """A client connection to an `agit serve` daemon."""
+
+    def __init__(self, url):
+        scheme, address = parse_url(url)
+        if scheme == 'unix':
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(address)
+        else:
+            self._sock = socket.create_connection(address)
+        self._file = self._sock.makefile('rwb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def _read_exactly(self, size):
+        content = self._file.read(size)
+        if len(content) < size:
+            raise ValueError('Connection closed by the remote')
+        return content
+
+    def _read_frame(self):
+        return self._read_exactly(decode_length(self._read_exactly(_LENGTH.size)))
+
+    def send(self, message):
+        self._file.write(encode_message(message))
+        self._file.flush()
+
+    def receive(self):
+        """Read a reply, raising ValueError if it reports an error."""
+        message = json.loads(self._read_frame())
+        if 'error' in message:
+            raise ValueError(message['error'])
+        return message
+
+    def request(self, message):
+        self.send(message)
+        return self.receive()
+
+    def send_pack(self, pieces):
+        for payload in iter_frames(pieces):
+            self._file.write(encode_frame(payload))
+        self._file.write(encode_frame(b''))
+        self._file.flush()
+
+    def iter_pack(self):
+        """Yield the pieces of a pack sent by the server."""
+        while True:
+            payload = self._read_frame()
+            if not payload:
+                return
+            yield payload
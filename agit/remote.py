@@ -1,26 +1,98 @@
 import os
+import sys
+import time
 
 from . import data
 from . import base
+from . import protocol
 
 
 REMOTE_REFS_BASE = 'refs/heads'
 LOCAL_REFS_BASE = 'refs/remotes'
 
 
-def fetch(remote_path):
-    """Fetch objects and refs from a remote repository."""
-    # Get the refs from the remote repository
+def fetch(remote_path, depth=None, exclude=(), filter_spec=None):
+    """Fetch objects and refs from a remote repository, a path or a URL served by `agit serve`.
+
+    Given a depth, or names of remote refs to exclude, only that much of the
+    history of the remote branches is fetched and the repository becomes
+    shallow. Later fetches keep its boundary where it is, unless they are
+    given a depth again. Branches excluded themselves are not fetched.
+
+    With the 'blob:none' filter_spec, blobs are left on the remote, which
+    becomes the promisor remote they are fetched from when first needed,
+    see data.prefetch_objects(). Later fetches from it leave them out too.
+    """
+    if depth is not None and depth < 1:
+        raise ValueError(f'Depth must be at least 1, not {depth}')
+    if filter_spec not in (None, 'blob:none'):
+        raise ValueError(f'Unsupported filter {filter_spec}')
+    remote_id = remote_path if protocol.is_url(remote_path) else os.path.abspath(remote_path)
+    if data.get_config('remote.promisor') == remote_id:
+        filter_spec = 'blob:none'
+
+    # Let the remote list what it has beyond the commits we have too
+    local_refs = [ref.value for _, ref in data.iter_refs() if ref.value]
+    request = local_refs, data.get_shallow(), depth, list(exclude), filter_spec
+    if protocol.is_url(remote_path):
+        refs, shallow = _fetch_from_server(remote_path, *request)
+    else:
+        refs, shallow = _fetch_from_path(remote_path, *request)
+    if filter_spec and data.get_config('remote.promisor') != remote_id:
+        data.set_config('remote.promisor', remote_id)
+    # Before anything walks the new history
+    base.set_shallow(shallow)
+    refs = {remote_name: value for remote_name, value in refs.items() if data.object_exists(value)}
+
+    # Update the local refs all at once
+    with data.ref_transaction() as transaction:
+        for remote_name, value in refs.items():
+            refname = os.path.relpath(remote_name, REMOTE_REFS_BASE)
+            transaction.update(f'{LOCAL_REFS_BASE}/{refname}', data.RefValue(symbolic=False, value=value))
+
+    base.write_commit_graph(refs.values())
+
+
+def _fetch_from_path(remote_path, local_refs, shallow, depth, exclude, filter_spec):
+    """Fetch objects from a repository on disk, returning its refs and our new boundary commits."""
     refs = _get_remote_refs(remote_path, REMOTE_REFS_BASE)
+    with data.change_git_dir(remote_path):
+        objects, shallow = base.get_fetch_objects(
+            refs.values(), local_refs, shallow, depth, exclude, blobs=filter_spec != 'blob:none')
+
+    data.fetch_objects(objects, remote_path, _get_progress('Receiving objects', len(objects)))
+    return refs, shallow
+
+
+def _fetch_from_server(url, local_refs, shallow, depth, exclude, filter_spec):
+    """Fetch objects from an `agit serve` daemon, returning its refs and our new boundary commits."""
+    with protocol.Connection(url) as connection:
+        refs = connection.request({'command': 'ls-refs', 'prefix': REMOTE_REFS_BASE})['refs']
+        reply = connection.request({
+            'command': 'fetch', 'wants': list(refs.values()), 'haves': local_refs,
+            'shallow': sorted(shallow), 'depth': depth, 'exclude': exclude, 'filter': filter_spec,
+        })
+        if reply['count']:
+            data.receive_objects(connection.iter_pack(), _get_progress('Receiving objects', reply['count']))
+    return refs, set(reply['shallow'])
 
-    # Fetch missing objects by iterating over the refs
-    for oid in base.iter_objects_in_commits(refs.values()):
-        data.fetch_object_if_missing(oid, remote_path)
 
-    # Update the local refs
-    for remote_name, value in refs.items():
-        refname = os.path.relpath(remote_name, REMOTE_REFS_BASE)
-        data.update_ref(f'{LOCAL_REFS_BASE}/{refname}', data.RefValue(symbolic=False, value=value))
+def _get_progress(label, total):
+    """Return a progress callback reporting objects and throughput on stderr."""
+    start = last = time.monotonic()
+
+    def progress(count, size):
+        nonlocal last
+        now = time.monotonic()
+        if count < total and now - last < 0.1:
+            return
+        last = now
+        line = f'\r{label}: {count}/{total}'
+        if size:
+            line += f', {size / 2**20:.2f} MiB | {size / 2**20 / max(now - start, 1e-6):.2f} MiB/s'
+        print(line, end='\n' if count == total else '', file=sys.stderr, flush=True)
+
+    return progress
 
 
 def _get_remote_refs(remote_path, prefix=''):
@@ -30,26 +102,39 @@ def _get_remote_refs(remote_path, prefix=''):
 
 
 def push(remote_path, refname):
-    # Get the ref from the local repository
+    """Push a branch to a remote repository, a path or a URL served by `agit serve`."""
+    if protocol.is_url(remote_path):
+        with protocol.Connection(remote_path) as connection:
+            remote_refs = connection.request({'command': 'ls-refs'})['refs']
+            remote_ref, local_ref, objects = _get_push_objects(refname, remote_refs)
+            connection.send({'command': 'push', 'ref': refname, 'old': remote_ref, 'new': local_ref,
+                             'count': len(objects)})
+            if objects:
+                progress = _get_progress('Sending objects', len(objects))
+                connection.send_pack(data.stream_objects(objects, progress))
+            connection.receive()
+        return
+
     remote_refs = _get_remote_refs(remote_path)
-    remote_refs = remote_refs.get(refname)
-    local_ref = data.get_ref(refname).value
-    assert local_ref
+    remote_ref, local_ref, objects = _get_push_objects(refname, remote_refs)
+    data.push_objects(objects, remote_path, _get_progress('Sending objects', len(objects)))
 
-    # Don't push if the remote ref is an ancestor of the local ref
-    assert not remote_refs or base.is_ancestor_of(local_ref, remote_refs)
+    # Update the remote ref, unless someone else pushed to it meanwhile
+    with data.change_git_dir(remote_path):
+        with data.ref_transaction() as transaction:
+            transaction.update(refname, data.RefValue(symbolic=False, value=local_ref), old=remote_ref)
 
-    # Compute which objects to push
-    known_remote_refs = filter(data.object_exists, remote_refs.values())
-    remote_objects = set(base.iter_objects_in_commits(known_remote_refs))
-    local_objects = set(base.iter_objects_in_commits({local_ref}))
-    objects_to_push = local_objects - remote_objects
 
-    # Push missing objects
-    for oid in objects_to_push:
-        data.push_object(oid, remote_path)
+def _get_push_objects(refname, remote_refs):
+    """Return the remote and local values of a ref and the objects to push for it."""
+    remote_ref = remote_refs.get(refname)
+    local_ref = data.get_ref(refname).value
+    assert local_ref
 
-    # Update the remote ref
-    with data.change_git_dir(remote_path):
-        data.update_ref(refname, data.RefValue(symbolic=False, value=local_ref))
+    # Only push if the remote ref is an ancestor of the local ref
+    assert not remote_ref or base.is_ancestor(local_ref, remote_ref)
+
+    # Negotiate: the remote has everything reachable from the refs we know too
+    haves = [oid for oid in remote_refs.values() if data.object_exists(oid)]
 
+    return remote_ref, local_ref, list(base.iter_missing_objects([local_ref], haves))
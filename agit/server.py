@@ -0,0 +1,205 @@
+"""`agit serve`: a daemon serving the repository to remote clients.
+
+A single asyncio loop accepts any number of connections and answers the
+requests described in protocol. Walking history and reading or writing
+packs block, so they run in worker threads, trading pack data with the
+connection frame by frame as it is produced or arrives. Parsed objects,
+packs and bitmaps stay cached in the process across requests; refs are
+read afresh for each request, so clients see each other's pushes.
+"""
+
+import asyncio
+import json
+import os
+import signal
+
+from . import base
+from . import data
+from . import protocol
+
+
+def serve(url, on_ready=None):
+    """Serve the repository on a remote URL until interrupted or terminated.
+
+    on_ready is called once the socket is listening.
+    """
+    scheme, address = protocol.parse_url(url)
+    try:
+        asyncio.run(_serve(scheme, address, on_ready))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if scheme == 'unix' and os.path.exists(address):
+            os.remove(address)
+
+
+async def _serve(scheme, address, on_ready):
+    if scheme == 'unix':
+        server = await asyncio.start_unix_server(_handle_connection, address)
+    else:
+        server = await asyncio.start_server(_handle_connection, *address)
+    # Stop on SIGTERM as on Ctrl-C, cleaning up the same way
+    stopped = asyncio.get_running_loop().create_future()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set_result, None)
+    except NotImplementedError:
+        pass
+    async with server:
+        if on_ready:
+            on_ready()
+        await stopped
+
+
+async def _read_frame(reader):
+    header = await reader.readexactly(protocol.FRAME_HEADER_SIZE)
+    return await reader.readexactly(protocol.decode_length(header))
+
+
+async def _write_frame(writer, payload):
+    writer.write(protocol.encode_frame(payload))
+    await writer.drain()
+
+
+async def _write_message(writer, message):
+    writer.write(protocol.encode_message(message))
+    await writer.drain()
+
+
+async def _handle_connection(reader, writer):
+    try:
+        while True:
+            try:
+                frame = await _read_frame(reader)
+            except asyncio.IncompleteReadError:
+                break
+            try:
+                request = json.loads(frame)
+                command = _COMMANDS.get(request.get('command'))
+                if command is None:
+                    raise ValueError(f'Unknown command {request.get("command")}')
+                data.clear_ref_cache()
+                reply = await command(request, reader, writer)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                raise
+            except Exception as e:
+                # The connection may be mid-pack, so it can't go on
+                await _write_message(writer, {'error': str(e) or type(e).__name__})
+                break
+            if reply is not None:
+                await _write_message(writer, reply)
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _ls_refs(request, reader, writer):
+    refs = await asyncio.to_thread(_get_refs, request.get('prefix', ''))
+    return {'refs': refs}
+
+
+def _get_refs(prefix):
+    return {refname: ref.value for refname, ref in data.iter_refs(prefix) if ref.value}
+
+
+async def _fetch(request, reader, writer):
+    objects, shallow = await asyncio.to_thread(
+        _get_missing_objects, request['wants'], request['haves'], request.get('shallow', []),
+        request.get('depth'), request.get('exclude', []), request.get('filter') != 'blob:none')
+    await _write_message(writer, {'count': len(objects), 'shallow': sorted(shallow)})
+    if objects:
+        await asyncio.to_thread(_send_pack, asyncio.get_running_loop(), writer, objects)
+    # The pack is the reply
+    return None
+
+
+def _get_missing_objects(wants, haves, shallow, depth, exclude, blobs):
+    # Only what ls-refs lists is served, never other names or objects
+    refs = _get_refs('')
+    _check_wants(wants, set(refs.values()))
+    exclude = [_resolve_ref_name(name, refs) for name in exclude]
+    return base.get_fetch_objects(wants, haves, shallow, depth, exclude, blobs)
+
+
+def _check_wants(wants, tips):
+    for oid in wants:
+        if oid not in tips and not any(base.is_ancestor(tip, oid) for tip in tips):
+            raise ValueError(f'Object {oid} not found')
+
+
+def _resolve_ref_name(name, refs):
+    """Resolve a name as base.get_oid() does, but only among refs."""
+    if name == '@':
+        name = 'HEAD'
+    for refname in (name, f'refs/{name}', f'refs/tags/{name}', f'refs/heads/{name}'):
+        if refname in refs:
+            return refs[refname]
+    raise ValueError(f'Unknown name {name}')
+
+
+def _check_objects(oids):
+    for oid in oids:
+        if not data.object_exists(oid):
+            raise ValueError(f'Object {oid} not found')
+
+
+async def _get_objects(request, reader, writer):
+    await asyncio.to_thread(_check_objects, request['oids'])
+    await _write_message(writer, {'count': len(request['oids'])})
+    if request['oids']:
+        await asyncio.to_thread(_send_pack, asyncio.get_running_loop(), writer, request['oids'])
+    return None
+
+
+def _send_pack(loop, writer, objects):
+    """Stream a pack of objects from a worker thread."""
+    for payload in protocol.iter_frames(data.stream_objects(objects)):
+        asyncio.run_coroutine_threadsafe(_write_frame(writer, payload), loop).result()
+    asyncio.run_coroutine_threadsafe(_write_frame(writer, b''), loop).result()
+
+
+async def _push(request, reader, writer):
+    # Refuse bad refnames before taking any objects
+    _check_refname(request['ref'])
+    if request['count']:
+        await asyncio.to_thread(_receive_pack, asyncio.get_running_loop(), reader)
+    await asyncio.to_thread(_update_ref, request['ref'], request['old'], request['new'])
+    return {}
+
+
+def _receive_pack(loop, reader):
+    """Store a pack arriving on a connection from a worker thread."""
+    def iter_pieces():
+        while True:
+            payload = asyncio.run_coroutine_threadsafe(_read_frame(reader), loop).result()
+            if not payload:
+                return
+            yield payload
+
+    data.receive_objects(iter_pieces())
+
+
+def _check_refname(refname):
+    data.check_refname(refname)
+    if not refname.startswith('refs/heads/'):
+        raise ValueError(f'Can only push to branches, not {refname}')
+
+
+def _update_ref(refname, old, new):
+    _check_refname(refname)
+    if not data.object_exists(new):
+        raise ValueError(f'Object {new} not found')
+    # The pack may have left out objects, claiming the server has them
+    base.check_connected(new, _get_refs('').values())
+    if old and not base.is_ancestor(new, old):
+        raise ValueError(f'{refname} at {old[:10]} is not an ancestor of {new[:10]}')
+    with data.ref_transaction() as transaction:
+        transaction.update(refname, data.RefValue(symbolic=False, value=new), old=old)
+
+
+_COMMANDS = {
+    'ls-refs': _ls_refs,
+    'fetch': _fetch,
+    'get-objects': _get_objects,
+    'push': _push,
+}
@@ -0,0 +1,78 @@
+"""Sparse checkout: only part of the tree in the working directory.
+
+info/sparse-checkout lists directories one per line, as cone patterns:
+every file below a listed directory is checked out, and so are the files
+directly in the root and in the directories above a listed one. The
+rest of the tree is left out of the working directory. The index keeps
+each left-out directory as a single entry, its path with a trailing
+slash and its tree oid, so the whole tree is still written from it
+without reading what is below. Merge conflicts are checked out wherever
+they are, so they can be resolved, until the next checkout leaves them
+out again.
+"""
+
+import os
+
+from . import data
+
+
+class Cone:
+    """The files a set of cone patterns checks out."""
+
+    def __init__(self, dirnames):
+        self.dirnames = frozenset(dirname.strip('/') for dirname in dirnames)
+        # Directories whose own files are checked out, but not all of their subdirectories
+        self._parents = {''}
+        for dirname in self.dirnames:
+            while dirname:
+                dirname = dirname.rpartition('/')[0]
+                self._parents.add(dirname)
+
+    def _is_below(self, dirname):
+        """Tell whether a directory is one of the listed ones or below one."""
+        while dirname:
+            if dirname in self.dirnames:
+                return True
+            dirname = dirname.rpartition('/')[0]
+        return False
+
+    def includes_dir(self, dirname):
+        """Tell whether any file below a directory is checked out."""
+        return dirname in self._parents or self._is_below(dirname)
+
+    def includes(self, path):
+        """Tell whether a file is checked out."""
+        dirname = path.rpartition('/')[0]
+        return dirname in self._parents or self._is_below(dirname)
+
+
+def is_sparse_dir(path):
+    """Tell whether an index path stands for a whole left-out directory."""
+    return path.endswith('/')
+
+
+def _path():
+    return os.path.join(data.GIT_DIR, 'info', 'sparse-checkout')
+
+
+def load():
+    """Return the repository's Cone, or None if the whole tree is checked out."""
+    try:
+        with open(_path()) as f:
+            lines = [line.strip() for line in f]
+    except FileNotFoundError:
+        return None
+    return Cone(line for line in lines if line and not line.startswith('#'))
+
+
+def write(dirnames):
+    """Set the checked out directories, or check out the whole tree if dirnames is None."""
+    path = _path()
+    if dirnames is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(''.join(f'{dirname}\n' for dirname in sorted({d.strip('/') for d in dirnames})))